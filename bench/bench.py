@@ -0,0 +1,302 @@
+"""Benchmarks for the matching engine and the MetaParser bootstrap.
+
+Run from anywhere with
+
+    python bench/bench.py
+
+to measure every workload and compare it against the saved baseline, if
+there is one; --save stores the results as the new baseline instead.
+Workloads are generated from fixed seeds, so runs on the same machine are
+comparable. A metric that got worse than the baseline by more than the
+tolerance is reported, and makes the exit status 1. Timings only compare
+on the same machine, so the baseline (bench/baseline.json) isn't checked
+in; --quick runs have a baseline of their own.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import metaparser
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MATH_GRAMMAR = os.path.join(root, "test", "math.bbnf")
+MATH_HANDLERS = os.path.join(root, "test", "math.py")
+
+# Whether a bigger value of a metric is better, by metric name
+BETTER_HIGHER = {"bytesPerSecond": True, "seconds": False, "peakBytes": False, "frames": False}
+
+benchmarks = []
+
+
+def benchmark(name):
+    def register(function):
+        benchmarks.append((name, function))
+        return function
+    return register
+
+
+def best(function, repeat):
+    """Smallest wall time of repeat calls of function."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peakMemory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def peakFrames(function):
+    """Deepest Python stack reached while function runs, relative to the call."""
+    depth = peak = 0
+
+    def profile(frame, event, arg):
+        nonlocal depth, peak
+        if event == "call":
+            depth += 1
+            peak = max(peak, depth)
+        elif event == "return":
+            depth -= 1
+
+    sys.setprofile(profile)
+    try:
+        function()
+    finally:
+        sys.setprofile(None)
+    return peak
+
+
+def parseWith(parserClass, text, **parseArgs):
+    def run():
+        parser = parserClass()
+        parser.feed(text)
+        return parser.parse(**parseArgs)
+    return run
+
+
+def throughput(parserClass, text, repeat, **parseArgs):
+    seconds = best(parseWith(parserClass, text, **parseArgs), repeat)
+    return {"seconds": seconds, "bytesPerSecond": len(text.encode()) / seconds}
+
+
+def longExpression(terms, seed=1):
+    rng = random.Random(seed)
+    parts = [str(rng.randrange(1, 1000))]
+    for i in range(terms - 1):
+        factor = str(rng.randrange(1, 1000))
+        if rng.random() < 0.2:
+            factor = f"({factor}{rng.choice('+-')}{rng.randrange(1, 1000)})"
+        parts.append(rng.choice("+-*") + factor)
+    return "".join(parts)
+
+
+def nestedExpression(depth):
+    return "(" * depth + "1" + ")" * depth
+
+
+def largeGrammar(rules, seed=1):
+    """Source of a .bbnf grammar with the given number of rules."""
+    rng = random.Random(seed)
+    lines = ["#:name generated", "#:main rule0", ""]
+    for i in range(rules):
+        alternatives = []
+        for j in range(rng.randrange(1, 4)):
+            items = [f'"kw{i}_{j}"']
+            if i + 1 < rules:
+                items.append(f"rule{rng.randrange(i + 1, rules)}")
+            if rng.random() < 0.5:
+                items.append(f'["a"-"z"] * (0, inf)')
+            if rng.random() < 0.3:
+                items.append('({",;"} + ["0"-"9"] * (1, inf)) * (0, 1)')
+            alternatives.append(" + ".join(items))
+        lines.append(f"rule{i} ::= " + " | ".join(alternatives))
+    return "\n".join(lines) + "\n"
+
+
+def loadMath(**kwargs):
+    return metaparser.loadGrammar(MATH_GRAMMAR, MATH_HANDLERS, **kwargs)
+
+
+@benchmark("math-long")
+def mathLong(quick):
+    parser = loadMath()
+    text = longExpression(2000 if quick else 20000)
+    return throughput(parser, text, 3)
+
+
+@benchmark("math-long-compiled")
+def mathLongCompiled(quick):
+    parser = loadMath()
+    parser.compile()
+    text = longExpression(2000 if quick else 20000)
+    return throughput(parser, text, 3)
+
+
+@benchmark("math-long-memory")
+def mathLongMemory(quick):
+    parser = loadMath()
+    text = longExpression(2000 if quick else 20000)
+    return {"peakBytes": peakMemory(parseWith(parser, text)),
+            "eagerPeakBytes": peakMemory(parseWith(parser, text, eager=True))}
+
+
+@benchmark("math-deep")
+def mathDeep(quick):
+    parser = loadMath()
+    text = nestedExpression(2000 if quick else 20000)
+    return throughput(parser, text, 3)
+
+
+@benchmark("math-stack")
+def mathStack(quick):
+    """Python frames per level of nesting with the recursive engine."""
+    parser = loadMath()
+    depth = 50
+    return {"frames": peakFrames(parseWith(parser, nestedExpression(depth), engine="recursive")) / depth}
+
+
+@benchmark("backtracking")
+def backtracking(quick):
+    """A grammar that re-matches the same text exponentially often without a memo."""
+    source = ('#:name backtrack\n#:main s\n\n'
+              's ::= "(" + s + ")" + "!" | "(" + s + ")" | "x"\n')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "backtrack.bbnf")
+        with open(path, "w") as file:
+            file.write(source)
+        parser = metaparser.loadGrammar(path)
+    shallow = nestedExpression(12 if quick else 18).replace("1", "x")
+    deep = nestedExpression(2000).replace("1", "x")
+    return {"seconds": best(parseWith(parser, shallow), 1),
+            "memoSeconds": best(parseWith(parser, deep, memo="full"), 3)}
+
+
+@benchmark("math-tokens")
+def mathTokens(quick):
+    """math.bbnf with a lexer in front of it, on input with whitespace between all tokens."""
+    with open(MATH_GRAMMAR) as file:
+        source = file.read().replace("#:main expr\n", "#:main expr\n#:tokens number\n#:skip blank\n")
+    source += 'blank ::= {" \\t\\n"} * (1, inf)\n'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tokens.bbnf")
+        with open(path, "w") as file:
+            file.write(source)
+        parser = metaparser.loadGrammar(path, MATH_HANDLERS)
+    text = longExpression(2000 if quick else 20000)
+    for char in "+-*()":
+        text = text.replace(char, f" {char} ")
+    return throughput(parser, text, 3)
+
+
+@benchmark("metaparser-large-grammar")
+def metaparserLargeGrammar(quick):
+    source = largeGrammar(100 if quick else 1000)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "large.bbnf")
+        with open(path, "w") as file:
+            file.write(source)
+        cache = metaparser.GrammarCache(os.path.join(directory, "cache"))
+        seconds = best(lambda: metaparser.loadGrammar(path), 3)
+        metaparser.loadGrammar(path, cache=cache)
+        cachedSeconds = best(lambda: metaparser.loadGrammar(path, cache=cache), 3)
+    return {"seconds": seconds, "bytesPerSecond": len(source) / seconds, "cachedSeconds": cachedSeconds}
+
+
+@benchmark("startup")
+def startup(quick):
+    """Importing the module, bootstrapping the meta-grammar, and loading math.bbnf in a fresh interpreter."""
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); import metaparser; "
+            "imported = time.perf_counter(); metaparser.MetaParser(); bootstrapped = time.perf_counter(); "
+            "metaparser.loadGrammar(sys.argv[2], sys.argv[3]); "
+            "print(imported - start, bootstrapped - imported, time.perf_counter() - bootstrapped)")
+    runs = []
+    for i in range(3):
+        output = subprocess.run([sys.executable, "-c", code, root, MATH_GRAMMAR, MATH_HANDLERS],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append([float(value) for value in output.split()])
+    importSeconds, bootstrapSeconds, loadSeconds = (min(column) for column in zip(*runs))
+    return {"importSeconds": importSeconds, "bootstrapSeconds": bootstrapSeconds, "loadSeconds": loadSeconds}
+
+
+def kind(metric):
+    """The BETTER_HIGHER key a metric name ends with."""
+    for key in BETTER_HIGHER:
+        if metric == key or metric.endswith(key[0].upper() + key[1:]):
+            return key
+    return None
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of the metrics that regressed by more than tolerance."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            key = kind(metric)
+            if old is None or key is None or old == 0:
+                continue
+            change = value / old - 1
+            if BETTER_HIGHER[key]:
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{name}.{metric}: {old:.6g} -> {value:.6g} ({change:+.0%} worse)")
+    return regressions
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description="Benchmark metaparser and compare against a saved baseline.")
+    argParser.add_argument("names", nargs="*", help="benchmarks to run (all by default)")
+    argParser.add_argument("--quick", action="store_true", help="use smaller workloads")
+    argParser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    argParser.add_argument("--baseline", default=BASELINE, help="baseline file (default: bench/baseline.json)")
+    argParser.add_argument("--tolerance", type=float, default=0.25,
+                           help="relative change beyond which a metric counts as regressed (default: 0.25)")
+    args = argParser.parse_args(argv)
+
+    unknown = set(args.names) - {name for name, function in benchmarks}
+    if unknown:
+        argParser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    results = {}
+    for name, function in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        results[name] = function(args.quick)
+        print(f"{name}:", ", ".join(f"{metric}={value:.6g}" for metric, value in results[name].items()), flush=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    if args.save:
+        baseline.setdefault("quick" if args.quick else "full", {}).update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    regressions = compare(results, baseline.get("quick" if args.quick else "full", {}), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,88 +1,592 @@
 import string
 import importlib.util
-import os, pathlib
+import os, pathlib, sys
+import argparse
+import mmap
+import array
+import bisect
+import re
+import hashlib
+import pickle
+import multiprocessing
+import threading
+import functools
+import codecs
+import contextlib
+import time
 #import sys; sys.setrecursionlimit(10 ** 5)
 
 
 _isChar = lambda s: isinstance(s, str) and len(s) == 1
 _DEBUG = False
-_dbgCategories = {"general": True, "match": False, "matchres": False, "error": True, "mptest": True, "ctrl": True}
+_dbgCategories = {"general": True, "error": True, "mptest": True, "ctrl": True}
 dbg = lambda *args, **kwargs: print(f"[DBG:{args[0]}]", *args[1:], **kwargs) if _DEBUG and _dbgCategories.get(args[0], True) else None
 
 
+_MISS = object()
+_UNEVALUATED = object()
+_UNCACHED = object()  # The result of an ElementMatch an incremental parse may reuse: unevaluated, but kept once it is
+_DEFERRED = object()  # The result of an ElementMatch that evaluateDeep() evaluates on its own
+_grammarLock = threading.RLock()  # Held while a parser class sets up its grammar
+_atomicRegexes = sys.version_info >= (3, 11)  # re has atomic groups and possessive quantifiers since 3.11
+
+
 class ParserError(Exception):
     pass
 
 
 class MatchError(ParserError):
-    pass
+    """The input doesn't match the grammar; position, line, column and expected tell where and why."""
+    
+    def __init__(self, message=None, position=None, line=None, column=None, expected=()):
+        super().__init__(*(() if message is None else (message,)))
+        self.position = position
+        self.line = line
+        self.column = column
+        self.expected = list(expected)
+
+
+class _Deferred(BaseException):
+    """Raised by evaluate() on a match evaluateDeep() deferred; a BaseException so that handlers don't catch it."""
+    
+    def __init__(self, match):
+        self.match = match
 
 
 class UndefinedElementError(ParserError):
     pass
 
 
+class ParseContext:
+    """Per-parse state threaded through every Definition.match call."""
+    
+    def __init__(self, memo=None, window=4096, binary=False, hook=None, regular=True, eager=False):
+        if memo not in (None, "full", "bounded"):
+            raise ValueError("Memo mode must be None, 'full' or 'bounded'")
+        self.memo = {} if memo is not None else None
+        self.hook = hook
+        self.plain = memo is None and hook is None and not eager
+        self.eager = eager
+        self.memoAll = memo == "full"
+        self.binary = binary
+        self.window = window if memo == "bounded" else None
+        self.watermark = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reach = 0
+        self.regular = regular
+        self.seeds = {}
+        self.failure = 0
+        self.expected = set()
+        self.cut = True  # Nothing to commit outside every choice
+        self.open = 0
+        self.runs = None
+    
+    def recall(self, definition, buf, index):
+        if definition.inLeftCycle or (self.seeds and (definition, index) in self.seeds):
+            return definition._match(buf, index, self)
+        result = self.lookup(definition, index)
+        if result is not _MISS:
+            return result
+        outer, cut = self.reach, self.cut
+        self.reach = index
+        self.cut = False if cut is False else None
+        return self.store(definition, index, definition._match(buf, index, self), outer, cut)
+    
+    def lookup(self, definition, index):
+        """Return the memoized result of definition at index, or _MISS."""
+        bucket = self.memo.get(index)
+        if bucket is None:
+            if self.window is not None and index - self.window > self.watermark:
+                self._evict(index - self.window)
+            self.memo[index] = {}
+        elif definition in bucket:
+            self.hits += 1
+            result, reach, cut = bucket[definition]
+            if reach > self.reach:
+                self.reach = reach
+            if cut:
+                self.cut = True
+            return result
+        self.misses += 1
+        return _MISS
+    
+    def store(self, definition, index, result, outer, cut):
+        """Memoize a result computed with reach reset to index and cut cleared; outer and cut are their values before."""
+        reach = self.reach
+        if result is not None:
+            reach = max(reach, result[1])
+            if isinstance(definition, ElementDef):
+                result[0].lookahead = reach
+                if self.runs is not None and result[0].result is _UNEVALUATED:
+                    result[0].result = _UNCACHED
+        bucket = self.memo.get(index)
+        if bucket is not None:
+            bucket[definition] = (result, reach, self.cut is True)
+        self.reach = max(outer, reach)
+        self.cut = cut or self.cut
+        return result
+    
+    def fail(self, index, definition):
+        """Note that definition failed at index; callers check index >= self.failure first."""
+        if index > self.failure:
+            self.failure = index
+            self.expected = {definition}
+        else:
+            self.expected.add(definition)
+    
+    def _evict(self, watermark):
+        for i in range(self.watermark, watermark):
+            bucket = self.memo.pop(i, None)
+            if bucket is not None:
+                self.evictions += len(bucket)
+        self.watermark = watermark
+    
+    def forget(self, limit):
+        """Drop memo entries (and failures) that examined the input at or past limit."""
+        if self.failure >= limit:
+            self.failure = 0
+            self.expected = set()
+        for bucket in self.memo.values():
+            for definition in [d for d, (result, reach, cut) in bucket.items() if reach > limit]:
+                del bucket[definition]
+    
+    def seed(self, definition, index, result, reach):
+        self.memo.setdefault(index, {})[definition] = (result, reach, False)
+    
+    def run(self, definition, index):
+        """The run of items of definition that has one starting at index, and its position there, or None."""
+        found = self.runs.get(definition)
+        if found is None:
+            return None
+        firsts, runs = found
+        k = bisect.bisect_right(firsts, index) - 1
+        if k < 0:
+            return None
+        run = runs[k]
+        i = bisect.bisect_left(run[0], index)
+        if i == len(run[0]) or run[0][i] != index:
+            return None
+        return run, i
+    
+    def choice(self):
+        """Start matching a choice that cuts can commit; returns what endChoice() takes."""
+        outer = self.cut
+        if outer is False:
+            self.open += 1
+        self.cut = False
+        return outer
+    
+    def endChoice(self, outer):
+        """Stop matching a choice; returns whether a cut committed it."""
+        committed = self.cut
+        if outer is False:
+            self.open -= 1
+        self.cut = outer
+        return committed
+    
+    def commit(self, index):
+        """A cut was passed at index with every choice committed: drop the memo entries before it."""
+        if self.memo is not None and index > self.watermark:
+            self._evict(index)
+    
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": sum(map(len, self.memo.values())) if self.memo is not None else 0}
+
+
+class TraceHook:
+    """Callbacks around every ElementDef match of a parse; the base class ignores them."""
+    
+    def enter(self, definition, index):
+        pass
+    
+    def abandon(self):
+        pass
+    
+    def success(self, definition, index, end):
+        pass
+    
+    def fail(self, definition, index):
+        pass
+    
+    def leave(self, definition, index, result):
+        if result is None:
+            self.fail(definition, index)
+        else:
+            self.success(definition, index, result[1])
+
+
+class PrintTracer(TraceHook):
+    """Print every ElementDef match attempt, indented by nesting."""
+    
+    def __init__(self, file=None):
+        self.file = file
+        self.depth = 0
+    
+    def enter(self, definition, index):
+        print("  " * self.depth + f"{definition} @ {index}", file=self.file)
+        self.depth += 1
+    
+    def abandon(self):
+        self.depth = 0
+        print("-- out of stack, starting over", file=self.file)
+    
+    def success(self, definition, index, end):
+        self.depth -= 1
+        print("  " * self.depth + f"{definition} @ {index} -> {end}", file=self.file)
+    
+    def fail(self, definition, index):
+        self.depth -= 1
+        print("  " * self.depth + f"{definition} @ {index} failed", file=self.file)
+
+
+class ElementProfiler(TraceHook):
+    """Count calls, failures (backtracks) and time per ElementDef."""
+    
+    def __init__(self):
+        self.stats = {}
+        self.stack = []
+    
+    def enter(self, definition, index):
+        self.stack.append([time.perf_counter(), 0.0])
+    
+    def abandon(self):
+        self.stack = []
+    
+    def _exit(self, definition, failed):
+        started, nested = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        if self.stack:
+            self.stack[-1][1] += elapsed
+        stats = self.stats.get(definition)
+        if stats is None:
+            stats = self.stats[definition] = {"calls": 0, "fails": 0, "time": 0.0, "own": 0.0}
+        stats["calls"] += 1
+        stats["fails"] += failed
+        stats["time"] += elapsed
+        stats["own"] += elapsed - nested
+    
+    def success(self, definition, index, end):
+        self._exit(definition, False)
+    
+    def fail(self, definition, index):
+        self._exit(definition, True)
+    
+    def report(self, file=None):
+        """Print the stats as a table, most own time first."""
+        print(f"{'element':<20} {'calls':>10} {'fails':>10} {'time':>10} {'own':>10}", file=file)
+        for definition, stats in sorted(self.stats.items(), key=lambda item: -item[1]["own"]):
+            print(f"{definition.name:<20} {stats['calls']:>10} {stats['fails']:>10} "
+                  f"{stats['time']:>10.4f} {stats['own']:>10.4f}", file=file)
+
+
+class GrammarProfiler(TraceHook):
+    """Attribute parse work to the lines of a .bbnf grammar, through the spans of its ElementDefs."""
+    
+    def __init__(self):
+        self.stats = {}
+        self.stack = []
+        self.active = {}
+        self.nodes = {}
+        self.own = {}
+    
+    @staticmethod
+    def key(definition):
+        return definition.span[0] if definition.span is not None else definition.name
+    
+    def enter(self, definition, index):
+        key = self.key(definition)
+        parent = self.stack[-1][3] if self.stack else None
+        node = self.nodes.get((parent, definition))
+        if node is None:
+            node = self.nodes[parent, definition] = len(self.nodes)
+        self.active[key] = self.active.get(key, 0) + 1
+        # Frames are [start time, nested time, furthest index seen, node, key]
+        self.stack.append([time.perf_counter(), 0.0, index, node, key])
+    
+    def abandon(self):
+        self.stack = []
+        self.active = {}
+    
+    def _stats(self, key):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = {"elements": [], "calls": 0, "successes": 0, "fails": 0, "consumed": 0,
+                                       "rescanned": 0, "time": 0.0, "own": 0.0}
+        return stats
+    
+    def leave(self, definition, index, result):
+        started, nested, furthest, node, key = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        end = result[1] if result is not None else index
+        if self.stack:
+            outer = self.stack[-1]
+            outer[1] += elapsed
+            if index < outer[2]:
+                self._stats(outer[4])["rescanned"] += min(outer[2], max(furthest, end)) - index
+            outer[2] = max(outer[2], furthest, end)
+        self.active[key] -= 1
+        stats = self._stats(key)
+        if definition.name not in stats["elements"]:
+            stats["elements"].append(definition.name)
+        stats["calls"] += 1
+        if result is None:
+            stats["fails"] += 1
+        else:
+            stats["successes"] += 1
+            stats["consumed"] += end - index
+        if not self.active[key]:
+            stats["time"] += elapsed
+        stats["own"] += elapsed - nested
+        self.own[node] = self.own.get(node, 0.0) + elapsed - nested
+    
+    def report(self, file=None):
+        """Print the stats as a table, most own time first."""
+        print(f"{'line':<8} {'elements':<20} {'calls':>10} {'successes':>10} {'fails':>10} {'consumed':>10} "
+              f"{'rescanned':>10} {'time':>10} {'own':>10}", file=file)
+        for key, stats in sorted(self.stats.items(), key=lambda item: -item[1]["own"]):
+            line = key if isinstance(key, int) else "-"
+            print(f"{line:<8} {','.join(stats['elements']):<20} {stats['calls']:>10} {stats['successes']:>10} "
+                  f"{stats['fails']:>10} {stats['consumed']:>10} {stats['rescanned']:>10} "
+                  f"{stats['time']:>10.4f} {stats['own']:>10.4f}", file=file)
+    
+    def collapsed(self, file=None):
+        """Print the own time of each nesting of elements as collapsed stacks in microseconds, for flame graphs."""
+        frames = {}
+        for (parent, definition), node in self.nodes.items():
+            frame = definition.name if definition.span is None else f"{definition.name}:{definition.span[0]}"
+            frames[node] = (parent, frame)
+        for node, own in self.own.items():
+            path = []
+            while node is not None:
+                node, frame = frames[node]
+                path.append(frame)
+            micros = round(own * 1e6)
+            if micros:
+                print(";".join(reversed(path)), micros, file=file)
+
+
 class Match:
-    pass
+    """A node of the Match tree, which keeps (start, end) offsets into its buffer and builds text on demand."""
+    
+    __slots__ = ()
+    encoding = "utf-8"
+    
+    @property
+    def value(self):
+        return self.buf[self.start:self.end]
+    
+    def __str__(self):
+        if isinstance(self.buf, str):
+            return self.buf[self.start:self.end]
+        return bytes(self.buf[self.start:self.end]).decode(self.encoding)
 
 
 class StringMatch(Match):
-    def __init__(self, value):
-        assert isinstance(value, str)
-        self.value = value
-        dbg("matchres", self)
+    __slots__ = ("buf", "start", "end")
     
-    def __str__(self):
-        return self.value
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+
+def _newStringMatch(buf, start, end):
+    """StringMatch(buf, start, end) without the constructor call, for hot paths."""
+    match = object.__new__(StringMatch)
+    match.buf = buf
+    match.start = start
+    match.end = end
+    return match
 
 
 class ConcatenationMatch(Match):
-    def __init__(self, inners):
+    """buf is None when the inners come from different buffers, as in streaming parses."""
+    
+    __slots__ = ("inners", "buf", "start", "end")
+    
+    def __init__(self, inners, buf=None, start=None, end=None):
         if not all([isinstance(e, Match) for e in inners]):
             raise ValueError("All inner values must be instances of Match")
         self.inners = inners
-        dbg("matchres", self)
+        self.buf = buf
+        self.start = start
+        self.end = end
     
     def __str__(self):
-        return "".join([str(e) for e in self.inners if e])
+        if self.buf is None:
+            return "".join([str(e) for e in self.inners])
+        return super().__str__()
+
+
+class RunMatch(ConcatenationMatch):
+    """A repetition of a CharClass; its per-character inners are only built if asked for."""
+    
+    __slots__ = ("charClass", "cache")
+    
+    def __init__(self, buf, start, end, charClass):
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.charClass = charClass
+        self.cache = None
+    
+    @property
+    def inners(self):
+        if self.cache is None:
+            self.cache = self.charClass.items(self.buf, self.start, self.end)
+        return self.cache
+
+
+class RepeatMatch(ConcatenationMatch):
+    """The items of a RepetitionDef as incremental parses match them, with where each one was found."""
+    
+    __slots__ = ("definition", "starts", "ends", "lookaheads")
+    
+    def __init__(self, inners, buf, start, end, definition, starts, ends, lookaheads):
+        self.inners = inners
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.definition = definition
+        self.starts = starts
+        self.ends = ends
+        self.lookaheads = lookaheads
+    
+    def slice(self, first, last):
+        """The RepeatMatch of just the items from first up to last."""
+        return RepeatMatch(self.inners[first:last], self.buf, self.starts[first], self.ends[last - 1], self.definition,
+                           self.starts[first:last], self.ends[first:last], self.lookaheads[first:last])
 
 
 class DisjunctionMatch(Match):
+    __slots__ = ("inner", "id")
+    
     def __init__(self, inner, id):
         if not (isinstance(inner, Match) and isinstance(id, int)):
             dbg("error", inner, id)
             raise ValueError("Inner value must be an instance of Match, id must be int")
         self.inner = inner
         self.id = id
-        dbg("matchres", self)
+    
+    buf = property(lambda self: self.inner.buf)
+    start = property(lambda self: self.inner.start)
+    end = property(lambda self: self.inner.end)
     
     def __str__(self):
         return str(self.inner)
 
 
 class ElementMatch(Match):
-    def __init__(self, inner, name="unnamed", handler=lambda inner: None):
+    """Name and handler come from definition; lookahead and shift serve incremental reparsing."""
+    
+    __slots__ = ("inner", "definition", "lookahead", "shift", "result")
+    
+    def __init__(self, inner, definition):
         if not isinstance(inner, Match):
             raise ValueError("Inner value must be an instance of Match")
         self.inner = inner
-        self.name = name
-        self.handler = handler
-        dbg("matchres", self)
+        self.definition = definition
+        self.lookahead = None
+        self.shift = 0
+        self.result = _UNEVALUATED
+    
+    name = property(lambda self: self.definition.name)
+    handler = property(lambda self: self.definition.handler)
+    buf = property(lambda self: self.inner.buf)
+    start = property(lambda self: self.inner.start)
+    end = property(lambda self: self.inner.end)
+    
+    def elements(self):
+        """The nearest ElementMatches below this one, in order."""
+        result = []
+        stack = [self.inner]
+        while stack:
+            match = stack.pop()
+            if isinstance(match, ElementMatch):
+                result.append(match)
+            elif isinstance(match, ConcatenationMatch) and not isinstance(match, RunMatch):
+                stack.extend(reversed(match.inners))
+            elif isinstance(match, DisjunctionMatch):
+                stack.append(match.inner)
+        return result
     
     def evaluate(self):
-        return self.handler(self.inner)
+        result = self.result
+        if result is _UNEVALUATED:
+            return self.definition.handler(self.inner)
+        if result is _UNCACHED:
+            result = self.result = self.definition.handler(self.inner)
+        elif result is _DEFERRED:
+            raise _Deferred(self)
+        return result
+    
+    def reduce(self):
+        """Run the handler now and replace the inner tree with a plain StringMatch of its text."""
+        if self.result is _UNEVALUATED:
+            inner = self.inner
+            self.result = self.definition.handler(inner)
+            self.inner = _newStringMatch(inner.buf, inner.start, inner.end)
     
     def __str__(self):
         return str(self.inner)
 
 
+class LazyElementMatch(ElementMatch):
+    """An ElementMatch found by an ElementRegex; its inner is only matched when asked for."""
+    
+    __slots__ = ("region", "cache")
+    
+    def __init__(self, definition, buf, start, end):
+        self.definition = definition
+        self.region = (buf, start, end)
+        self.cache = None
+        self.lookahead = None
+        self.shift = 0
+        self.result = _UNEVALUATED
+    
+    buf = property(lambda self: self.region[0])
+    start = property(lambda self: self.region[1])
+    end = property(lambda self: self.region[2])
+    
+    @property
+    def inner(self):
+        if self.cache is None:
+            buf, start, end = self.region
+            ctx = ParseContext(binary=not isinstance(buf, str), regular=False)
+            self.cache = self.definition.definition.match(buf, start, ctx)[0]
+        return self.cache
+    
+    def reduce(self):
+        if self.result is _UNEVALUATED:
+            self.result = self.definition.handler(self.inner)
+            self.cache = None
+    
+    def __str__(self):
+        return Match.__str__(self)
+
+
 class Definition:
-    def check(self, buf, index):
+    shallow = True
+    inLeftCycle = False
+    span = None  # (line, column, end line, end column) of the .bbnf text it was built from, if it was
+    
+    def check(self, buf, index, ctx=None):
         return 0 <= index < len(buf)
     
-    def match(self, buf, index):
+    def match(self, buf, index, ctx):
+        """Return (match, index after it), or None if buf doesn't match at index."""
         raise NotImplementedError()
     
+    def children(self):
+        return []
+    
+    def steps(self, buf, index, ctx):
+        """Generator form of match for the explicit-stack engine."""
+        return (yield from ())
+    
     @staticmethod
     def _convert(value):
         if isinstance(value, str):
@@ -128,28 +632,50 @@ class Definition:
         if isinstance(other, Definition):
             return DisjunctionDef([other, self])
         return NotImplemented
+    
+    def __rshift__(self, other):
+        other = self._convert(other)
+        if isinstance(other, Definition):
+            return ConcatenationDef([self, CutDef(), other])
+        return NotImplemented
+    
+    def __rrshift__(self, other):
+        other = self._convert(other)
+        if isinstance(other, Definition):
+            return ConcatenationDef([other, CutDef(), self])
+        return NotImplemented
 
 
 class StringDef(Definition):
+    encoding = "utf-8"
+    
     def __init__(self, value):
         if not isinstance(value, str):
             raise ValueError("Value must be str")
         self.value = value
+        self.encoded = value.encode(self.encoding)
     
-    def check(self, buf, index):
-        return super().check(buf, index) and buf[index:index + len(self.value)] == self.value
+    def check(self, buf, index, ctx=None):
+        value = self.value if isinstance(buf, str) else self.encoded
+        return super().check(buf, index) and buf[index:index + len(value)] == value
     
-    def match(self, buf, index):
-        dbg("match", "strg", index, self)
+    def match(self, buf, index, ctx):
+        size = len(self.encoded if ctx.binary else self.value)
         if not self.check(buf, index):
-            raise MatchError()
-        return StringMatch(self.value), index + len(self.value)
+            if index + max(size, 1) > ctx.reach:
+                ctx.reach = index + max(size, 1)
+            if index >= ctx.failure:
+                ctx.fail(index, self)
+            return None
+        return StringMatch(buf, index, index + size), index + size
     
     def __str__(self):
         return repr(self.value)
 
 
 class CharRangeDef(Definition):
+    """A character range; over binary buffers it is the byte range of the ordinals."""
+    
     def __init__(self, left, right, inverted=False):
         if not (_isChar(left) and _isChar(right)):
             raise ValueError("Borders must be 1-long strings")
@@ -157,14 +683,22 @@ class CharRangeDef(Definition):
         self.right = right
         self.inverted = inverted
     
-    def check(self, buf, index):
-        return super().check(buf, index) and ((self.left <= buf[index] <= self.right) ^ self.inverted)
+    def check(self, buf, index, ctx=None):
+        if not super().check(buf, index):
+            return False
+        char = buf[index]
+        if isinstance(char, int):
+            return (ord(self.left) <= char <= ord(self.right)) ^ self.inverted
+        return (self.left <= char <= self.right) ^ self.inverted
     
-    def match(self, buf, index):
-        dbg("match", "chrr", index, self)
+    def match(self, buf, index, ctx):
         if not self.check(buf, index):
-            raise MatchError()
-        return StringMatch(buf[index]), index + 1
+            if index >= ctx.reach:
+                ctx.reach = index + 1
+            if index >= ctx.failure:
+                ctx.fail(index, self)
+            return None
+        return StringMatch(buf, index, index + 1), index + 1
     
     def __invert__(self):
         return CharRangeDef(self.left, self.right, inverted=(not self.inverted))
@@ -174,21 +708,27 @@ class CharRangeDef(Definition):
 
 
 class CharSetDef(Definition):
+    """A character set; members also holds the ordinals below 256 for binary buffers."""
+    
     def __init__(self, value, inverted=False):
         value = set(value)
         if not all([_isChar(e) for e in value]):
             raise ValueError("Value must be a set of 1-long strings")
         self.value = value
+        self.members = frozenset(value) | frozenset(ord(e) for e in value if ord(e) < 256)
         self.inverted = inverted
     
-    def check(self, buf, index):
-        return super().check(buf, index) and ((buf[index] in self.value) ^ self.inverted)
+    def check(self, buf, index, ctx=None):
+        return super().check(buf, index) and ((buf[index] in self.members) ^ self.inverted)
     
-    def match(self, buf, index):
-        dbg("match", "chrs", index, self)
+    def match(self, buf, index, ctx):
         if not self.check(buf, index):
-            raise MatchError()
-        return StringMatch(buf[index]), index + 1
+            if index >= ctx.reach:
+                ctx.reach = index + 1
+            if index >= ctx.failure:
+                ctx.fail(index, self)
+            return None
+        return StringMatch(buf, index, index + 1), index + 1
     
     def __invert__(self):
         return CharSetDef(self.value, inverted=(not self.inverted))
@@ -197,55 +737,150 @@ class CharSetDef(Definition):
         return repr(self.value)
 
 
+class CutDef(Definition):
+    """Matches the empty string and commits the innermost choice being matched."""
+    
+    def check(self, buf, index, ctx=None):
+        return True
+    
+    def match(self, buf, index, ctx):
+        ctx.cut = True
+        if not ctx.open:
+            ctx.commit(index)
+        return StringMatch(buf, index, index), index
+    
+    def __str__(self):
+        return "~"
+
+
 class ConcatenationDef(Definition):
+    shallow = False
+    
     def __init__(self, inners):
         if not all([isinstance(e, Definition) for e in inners]):
             raise ValueError("All inner values must be instances of Definition")
         self.inners = inners
     
-    def check(self, buf, index):
-        try:
-            self.match(buf, index)
-            return True
-        except MatchError:
-            return False
+    def children(self):
+        return self.inners
     
-    def match(self, buf, index):
-        dbg("match", "conc", index, self)
+    def check(self, buf, index, ctx=None):
+        return self.match(buf, index, ctx if ctx is not None else ParseContext(binary=not isinstance(buf, str))) is not None
+    
+    def match(self, buf, index, ctx):
+        if ctx.memoAll:
+            return ctx.recall(self, buf, index)
+        return self._match(buf, index, ctx)
+    
+    def _match(self, buf, index, ctx):
+        start = index
         innerMatches = []
         for innerDef in self.inners:
-            innerMatch, index = innerDef.match(buf, index)
+            result = innerDef.match(buf, index, ctx)
+            if result is None:
+                return None
+            innerMatch, index = result
             innerMatches.append(innerMatch)
-        return ConcatenationMatch(innerMatches), index
+        return ConcatenationMatch(innerMatches, buf, start, index), index
+    
+    def steps(self, buf, index, ctx):
+        start = index
+        innerMatches = []
+        for innerDef in self.inners:
+            result = yield innerDef, index
+            if result is None:
+                return None
+            innerMatch, index = result
+            innerMatches.append(innerMatch)
+        return ConcatenationMatch(innerMatches, buf, start, index), index
     
     def __str__(self):
         return "(" + " + ".join(map(str, self.inners)) + ")"
 
 
 class DisjunctionDef(Definition):
+    shallow = False
+    
     def __init__(self, inners):
         if not all([isinstance(e, Definition) for e in inners]):
             raise ValueError("All inner values must be instances of Definition")
         self.inners = inners
+        self.dispatch = None
+        self.fallback = ()
+        self.charClass = None
+        self.cuts = False  # Whether a CutDef can be reached from it, so cuts may commit it
     
-    def check(self, buf, index):
-        return any([e.check(buf, index) for e in self.inners])
+    def children(self):
+        return self.inners
     
-    def match(self, buf, index):
-        dbg("match", "disj", index, self)
-        for i, inner in enumerate(self.inners):
-            try:
-                innerMatch, index = inner.match(buf, index)
-                return DisjunctionMatch(innerMatch, i), index
-            except MatchError:
-                pass
-        raise MatchError()
+    def check(self, buf, index, ctx=None):
+        return any([e.check(buf, index, ctx) for e in self.inners])
+    
+    def match(self, buf, index, ctx):
+        if ctx.memoAll:
+            return ctx.recall(self, buf, index)
+        return self._match(buf, index, ctx)
+    
+    def _match(self, buf, index, ctx):
+        if self.charClass is not None:
+            return self.charClass.match(buf, index, ctx)
+        if self.cuts:
+            return self._choose(buf, index, ctx)
+        for i, inner in self._candidates(buf, index, ctx):
+            result = inner.match(buf, index, ctx)
+            if result is not None:
+                return DisjunctionMatch(result[0], i), result[1]
+        if self.dispatch is not None and index >= ctx.failure:
+            ctx.fail(index, self)
+        return None
+    
+    def _choose(self, buf, index, ctx):
+        """_match() for disjunctions that cuts can commit."""
+        outer = ctx.choice()
+        for i, inner in self._candidates(buf, index, ctx):
+            result = inner.match(buf, index, ctx)
+            if result is not None:
+                ctx.endChoice(outer)
+                return DisjunctionMatch(result[0], i), result[1]
+            if ctx.cut:
+                break
+        ctx.endChoice(outer)
+        if self.dispatch is not None and index >= ctx.failure:
+            ctx.fail(index, self)
+        return None
+    
+    def steps(self, buf, index, ctx):
+        outer = ctx.choice() if self.cuts else None
+        for i, inner in self._candidates(buf, index, ctx):
+            result = yield inner, index
+            if result is not None:
+                if outer is not None:
+                    ctx.endChoice(outer)
+                return DisjunctionMatch(result[0], i), result[1]
+            if outer is not None and ctx.cut:
+                break
+        if outer is not None:
+            ctx.endChoice(outer)
+        if self.dispatch is not None and index >= ctx.failure:
+            ctx.fail(index, self)
+        return None
+    
+    def _candidates(self, buf, index, ctx):
+        if self.dispatch is None:
+            return enumerate(self.inners)
+        if index >= ctx.reach:
+            ctx.reach = index + 1
+        if index < len(buf):
+            return self.dispatch.get(buf[index], self.fallback)
+        return self.fallback
     
     def __str__(self):
         return "(" + " | ".join(map(str, self.inners)) + ")"
 
 
 class RepetitionDef(Definition):
+    shallow = False
+    
     def __init__(self, inner, range):
         if not isinstance(inner, Definition):
             raise ValueError("Inner value must be an instance of Definition")
@@ -256,60 +891,235 @@ class RepetitionDef(Definition):
                     and 0 <= range[0] and -1 <= range[1]):
             raise ValueError("Repetition count must be int or tuple of two ints")
         self.range = range
+        self.run = None
+        self.cuts = False  # As for DisjunctionDef; a cut in an item that then fails fails the whole repetition
     
-    def check(self, buf, index):
-        try:
-            self.match(buf, index)
-            return True
-        except MatchError:
-            return False
+    def children(self):
+        return [self.inner]
+    
+    def check(self, buf, index, ctx=None):
+        return self.match(buf, index, ctx if ctx is not None else ParseContext(binary=not isinstance(buf, str))) is not None
+    
+    def match(self, buf, index, ctx):
+        if ctx.memoAll:
+            return ctx.recall(self, buf, index)
+        return self._match(buf, index, ctx)
     
-    def match(self, buf, index):
-        dbg("match", "rept", index, self)
+    def _match(self, buf, index, ctx):
+        if self.run is not None:
+            return self.run.repeat(buf, index, ctx, *self.range)
+        if ctx.runs is not None and self._reusable(index, ctx):
+            return self._reuse(buf, index, ctx)
+        if self.cuts:
+            return self._choose(buf, index, ctx)
+        start = index
         i = 0
         inners = []
-        while i < self.range[0]:
-            dbg("match", "rept_inner", i)
-            inner, index = self.inner.match(buf, index)
+        while self.range[1] == -1 or i < self.range[1]:
+            result = self.inner.match(buf, index, ctx)
+            if result is None:
+                break
+            inner, index = result
             inners.append(inner)
             i += 1
-        while self.range[1] == -1 or i < self.range[1]:
-            dbg("match", "rept_inner", i)
-            try:
-                inner, index = self.inner.match(buf, index)
-                inners.append(inner)
-                i += 1
-            except MatchError:
+        if i < self.range[0]:
+            return None
+        return ConcatenationMatch(inners, buf, start, index), index
+    
+    def _choose(self, buf, index, ctx):
+        """_match() for repetitions that cuts can commit."""
+        outer = ctx.choice()
+        start = index
+        inners = []
+        while self.range[1] == -1 or len(inners) < self.range[1]:
+            result = self.inner.match(buf, index, ctx)
+            if result is None:
+                break
+            inner, index = result
+            inners.append(inner)
+            ctx.cut = False
+        if ctx.endChoice(outer) or len(inners) < self.range[0]:
+            return None
+        return ConcatenationMatch(inners, buf, start, index), index
+    
+    def _reuse(self, buf, index, ctx):
+        """_match() for incremental parses, which take over runs of items of the previous one (see ParseContext.run)."""
+        outer = ctx.choice() if self.cuts else None
+        match = RepeatMatch([], buf, index, index, self, [], [], [])
+        while self.range[1] == -1 or len(match.inners) < self.range[1]:
+            if self._takeRun(match, ctx):
+                continue
+            reach, ctx.reach = ctx.reach, match.end
+            result = self.inner.match(buf, match.end, ctx)
+            if not self._addItem(match, result, reach, ctx):
+                break
+            if outer is not None:
+                ctx.cut = False
+        if outer is not None and ctx.endChoice(outer) or len(match.inners) < self.range[0]:
+            return None
+        return match, match.end
+    
+    def _reusable(self, index, ctx):
+        """Whether runs of items may be taken over here; like the memo, not while left recursion is involved."""
+        return not self.inLeftCycle and not (ctx.seeds and (self, index) in ctx.seeds)
+    
+    def _takeRun(self, match, ctx):
+        """Add the items of a reused run that has one at match.end to match; False if there is none."""
+        found = ctx.run(self, match.end)
+        if found is None:
+            return False
+        (starts, inners, ends, lookaheads), i = found
+        j = len(inners) if self.range[1] == -1 else min(len(inners), i + self.range[1] - len(match.inners))
+        match.inners.extend(inners[i:j])
+        match.starts.extend(starts[i:j])
+        match.ends.extend(ends[i:j])
+        match.lookaheads.extend(lookaheads[i:j])
+        match.end = ends[j - 1]
+        ctx.reach = max(ctx.reach, max(lookaheads[i:j]))
+        ctx.hits += 1
+        return True
+    
+    @staticmethod
+    def _addItem(match, result, reach, ctx):
+        """Add an item matched at match.end with ctx.reach reset from reach to match; False if it failed."""
+        if result is None:
+            ctx.reach = max(reach, ctx.reach)
+            return False
+        inner, end = result
+        lookahead = max(ctx.reach, end)
+        ctx.reach = max(reach, lookahead)
+        match.inners.append(inner)
+        match.starts.append(match.end)
+        match.ends.append(end)
+        match.lookaheads.append(lookahead)
+        match.end = end
+        return True
+    
+    def steps(self, buf, index, ctx):
+        outer = ctx.choice() if self.cuts else None
+        if ctx.runs is not None and self._reusable(index, ctx):
+            match = RepeatMatch([], buf, index, index, self, [], [], [])
+            while self.range[1] == -1 or len(match.inners) < self.range[1]:
+                if self._takeRun(match, ctx):
+                    continue
+                reach, ctx.reach = ctx.reach, match.end
+                result = yield self.inner, match.end
+                if not self._addItem(match, result, reach, ctx):
+                    break
+                if outer is not None:
+                    ctx.cut = False
+            if outer is not None and ctx.endChoice(outer) or len(match.inners) < self.range[0]:
+                return None
+            return match, match.end
+        start = index
+        inners = []
+        while self.range[1] == -1 or len(inners) < self.range[1]:
+            result = yield self.inner, index
+            if result is None:
                 break
-        return ConcatenationMatch(inners), index
+            inner, index = result
+            inners.append(inner)
+            if outer is not None:
+                ctx.cut = False
+        if outer is not None and ctx.endChoice(outer):
+            return None
+        if len(inners) < self.range[0]:
+            return None
+        return ConcatenationMatch(inners, buf, start, index), index
     
     def __str__(self):
         return f"{self.inner} * {self.range}"
 
 
+def _noHandler(inner):
+    return None
+
+
 class ElementDef(Definition):
-    def __init__(self, name="unnamed", handler=lambda inner: None):
+    shallow = False
+    
+    def __init__(self, name="unnamed", handler=_noHandler, inline=False):
         self.name = name
         self.definition = None
         self.handler = handler
+        self.inline = inline  # No handler evaluates its matches, so GrammarOptimizer may inline it anywhere
+        self.compiled = None
+        self.compiledBinary = None
+        self.regex = None
+        self.growsSeed = False
     
     def define(self, definition):
         if not isinstance(definition, Definition):
             raise ValueError("Definition must be an instance of Definition")
         self.definition = definition
+        self.compiled = None
+        self.compiledBinary = None
+        self.regex = None
+        self.growsSeed = False
     
     def isDefined(self):
         return self.definition is not None
     
-    def check(self, buf, index):
-        return self.isDefined() and super().check(buf, index) and self.definition.check(buf, index)
+    def children(self):
+        return [self.definition] if self.isDefined() else []
+    
+    def check(self, buf, index, ctx=None):
+        return self.isDefined() and super().check(buf, index) and self.definition.check(buf, index, ctx)
+    
+    def match(self, buf, index, ctx):
+        if ctx.plain:
+            return self._match(buf, index, ctx)
+        if ctx.hook is not None:
+            ctx.hook.enter(self, index)
+        result = ctx.recall(self, buf, index) if ctx.memo is not None else self._match(buf, index, ctx)
+        if ctx.eager and result is not None:
+            result[0].reduce()
+        if ctx.hook is not None:
+            ctx.hook.leave(self, index, result)
+        return result
+    
+    def _match(self, buf, index, ctx):
+        compiled = self.compiledBinary if ctx.binary else self.compiled
+        if compiled is not None:
+            return compiled(buf, index, ctx)
+        if self.regex is not None and ctx.regular:
+            return self.regex.match(buf, index, ctx)
+        if not self.isDefined():
+            raise UndefinedElementError()
+        if self.growsSeed:
+            return growSeed(self, self._body, buf, index, ctx)
+        result = self.definition.match(buf, index, ctx)
+        if result is None:
+            return None
+        return ElementMatch(result[0], self), result[1]
+    
+    def _body(self, buf, index, ctx):
+        result = self.definition.match(buf, index, ctx)
+        if result is None:
+            return None
+        return ElementMatch(result[0], self), result[1]
     
-    def match(self, buf, index):
-        dbg("match", "elem", index, self)
+    def steps(self, buf, index, ctx):
         if not self.isDefined():
             raise UndefinedElementError()
-        inner, index = self.definition.match(buf, index)
-        return ElementMatch(inner, name=self.name, handler=self.handler), index
+        if not self.growsSeed:
+            result = yield self.definition, index
+            if result is None:
+                return None
+            return ElementMatch(result[0], self), result[1]
+        key = (self, index)
+        if key in ctx.seeds:
+            return ctx.seeds[key]
+        ctx.seeds[key] = best = None
+        try:
+            while True:
+                result = yield self.definition, index
+                if result is None or (best is not None and result[1] <= best[1]):
+                    break
+                best = ctx.seeds[key] = ElementMatch(result[0], self), result[1]
+        finally:
+            ctx.seeds.pop(key, None)
+        return best
     
     def expand(self):
         return f"{self} ::= {self.definition}"
@@ -318,6 +1128,1249 @@ class ElementDef(Definition):
         return f"<{self.name}>"
 
 
+def walk(root):
+    """List every Definition reachable from root, depth first, each once."""
+    stack = [root]
+    seen = set()
+    result = []
+    while stack:
+        definition = stack.pop()
+        if definition in seen:
+            continue
+        seen.add(definition)
+        result.append(definition)
+        stack.extend(reversed(definition.children()))
+    return result
+
+
+def _parts(match, position):
+    """The nearest ElementMatches and RepeatMatches inside match, found at position, with their positions."""
+    result = []
+    stack = [match.inner if isinstance(match, ElementMatch) else match]
+    while stack:
+        inner = stack.pop()
+        if isinstance(inner, ElementMatch):
+            result.append((inner, position + inner.start + inner.shift - match.start))
+        elif isinstance(inner, RepeatMatch):
+            result.append((inner, position + inner.start - match.start))
+        elif isinstance(inner, ConcatenationMatch) and not isinstance(inner, RunMatch):
+            stack.extend(inner.inners)
+        elif isinstance(inner, DisjunctionMatch):
+            stack.append(inner.inner)
+    return result
+
+
+def _charRanges(intervals):
+    """Describe (low, high) code intervals as quoted characters and ranges, merging adjacent ones."""
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    result = []
+    for low, high in merged:
+        if high - low >= 2:
+            result.append(f"{chr(low)!r}..{chr(high)!r}")
+        else:
+            result.extend(repr(chr(code)) for code in range(low, high + 1))
+    return result
+
+
+def _expectations(definition, found):
+    """Describe what a definition that failed at a position would have matched there; None is end of input."""
+    if definition is None:
+        return ["end of input"]
+    if isinstance(definition, StringDef):
+        return [repr(definition.value)]
+    if isinstance(definition, CharRangeDef):
+        described = _charRanges([(ord(definition.left), ord(definition.right))])
+    elif isinstance(definition, CharSetDef):
+        described = _charRanges((ord(char), ord(char)) for char in definition.value)
+    elif isinstance(definition, DisjunctionDef):
+        codes = {key if isinstance(key, int) else ord(key) for key in definition.dispatch} - {found}
+        return _charRanges((code, code) for code in codes)
+    elif isinstance(definition, CharClass):
+        return _charRanges((low, high) for low, high, path in definition.intervals)
+    else:
+        return [str(definition)]
+    if definition.inverted:
+        return ["any character but " + ", ".join(described)]
+    return described
+
+
+def growSeed(elem, body, buf, index, ctx):
+    """Match a left-recursive element by growing a seed (Warth et al.)."""
+    key = (elem, index)
+    if key in ctx.seeds:
+        return ctx.seeds[key]
+    ctx.seeds[key] = best = None
+    try:
+        while True:
+            result = body(buf, index, ctx)
+            if result is None or (best is not None and result[1] <= best[1]):
+                break
+            best = ctx.seeds[key] = result
+    finally:
+        del ctx.seeds[key]
+    return best
+
+
+def matchIterative(root, buf, index, ctx):
+    """Explicit-stack equivalent of root.match(buf, index, ctx)."""
+    return _finish(matchSteps(root, buf, index, ctx))
+
+
+def matchSteps(root, buf, index, ctx, every=None):
+    """matchIterative() as a generator that yields None every `every` steps and returns the result."""
+    stack = []
+    definition = root
+    hook = ctx.hook
+    ticks = every or -1
+    while True:
+        ticks -= 1
+        if ticks == 0:
+            yield
+            ticks = every
+        if definition.shallow:
+            result = definition.match(buf, index, ctx)
+        else:
+            memoized = ctx.memo is not None and (ctx.memoAll or isinstance(definition, ElementDef)) \
+                and not definition.inLeftCycle and not (ctx.seeds and (definition, index) in ctx.seeds)
+            traced = hook is not None and isinstance(definition, ElementDef)
+            if traced:
+                hook.enter(definition, index)
+            if memoized and (result := ctx.lookup(definition, index)) is not _MISS:
+                if traced:
+                    hook.leave(definition, index, result)
+            else:
+                stack.append((definition.steps(buf, index, ctx), definition, index,
+                              (ctx.reach, ctx.cut) if memoized else None, traced))
+                if memoized:
+                    ctx.reach = index
+                    ctx.cut = False if ctx.cut is False else None
+                result = None
+        while True:
+            if not stack:
+                return result
+            frame, definition, index, outer, traced = stack[-1]
+            try:
+                definition, index = frame.send(result)
+                break
+            except StopIteration as stop:
+                stack.pop()
+                result = stop.value
+                if ctx.eager and result is not None and isinstance(definition, ElementDef):
+                    result[0].reduce()
+                if outer is not None:
+                    result = ctx.store(definition, index, result, *outer)
+                if traced:
+                    hook.leave(definition, index, result)
+
+
+def evaluateIterative(root):
+    """Evaluate a Match tree bottom-up with an explicit stack, running every handler once."""
+    return _finish(evaluateSteps(root))
+
+
+def evaluateSteps(root, every=None):
+    """evaluateIterative() as a generator that yields None every `every` steps, like matchSteps()."""
+    stack = [(root, False)]
+    ticks = every or -1
+    while stack:
+        ticks -= 1
+        if ticks == 0:
+            yield
+            ticks = every
+        match, ready = stack.pop()
+        if isinstance(match, ElementMatch):
+            if ready:
+                match.result = match.definition.handler(match.inner)
+            elif match.result is _UNEVALUATED or match.result is _UNCACHED:
+                stack.append((match, True))
+                stack.append((match.inner, False))
+        elif isinstance(match, ConcatenationMatch) and not isinstance(match, RunMatch):
+            stack.extend((inner, False) for inner in reversed(match.inners))
+        elif isinstance(match, DisjunctionMatch):
+            stack.append((match.inner, False))
+    return root.evaluate()
+
+
+def evaluateDeep(root, depth=100):
+    """Evaluate a Match tree like root.evaluate(), however deeply it nests."""
+    if not isinstance(root, ElementMatch) or root.result is not _UNEVALUATED and root.result is not _UNCACHED:
+        return root.evaluate()
+    deferred = []
+    stack = [(root, 0)]
+    while stack:
+        match, level = stack.pop()
+        if isinstance(match, ElementMatch):
+            if match.result is not _UNEVALUATED and match.result is not _UNCACHED or isinstance(match, LazyElementMatch):
+                continue  # Evaluated already, or regular and so only as deep as the grammar
+            if level and level % depth == 0:
+                deferred.append((match, match.result))
+                match.result = _DEFERRED
+            stack.append((match.inner, level + 1))
+        elif isinstance(match, ConcatenationMatch) and not isinstance(match, RunMatch):
+            stack.extend((inner, level) for inner in match.inners)
+        elif isinstance(match, DisjunctionMatch):
+            stack.append((match.inner, level))
+    pending = [root]
+    try:
+        while pending:
+            match = pending[-1]
+            try:
+                value = match.definition.handler(match.inner)
+            except _Deferred as nested:
+                pending.append(nested.match)
+                continue
+            pending.pop()
+            if match is root:
+                if root.result is _UNCACHED:
+                    root.result = value
+                return value
+            match.result = value
+    finally:
+        for match, result in deferred:
+            if match.result is _DEFERRED:
+                match.result = result
+
+
+def _finish(steps):
+    """Run a generator of steps to the end and return its value."""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+async def _chunks(source, size, text):
+    """The chunks of an asyncio.StreamReader, read size at a time, or of an async iterable."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    if hasattr(source, "read"):
+        async def read(reader):
+            while True:
+                chunk = await reader.read(size)
+                if not chunk:
+                    return
+                yield chunk
+        source = read(source)
+    async for chunk in source:
+        if text and not isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        elif not text and isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if chunk:
+            yield chunk
+    if text:
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+
+async def _cooperate(steps):
+    """Run a generator of steps to the end, letting the event loop run whenever it yields."""
+    import asyncio  # Here rather than at the top, since importing it would double the module's import time
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+        await asyncio.sleep(0)
+
+
+class CharClass:
+    """Lookup table for a definition that always matches a single character."""
+    
+    maxCode = 0x10FFFF
+    
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self.starts = [low for low, high, path in intervals]
+        self.table = [self._search(code) for code in range(256)]
+        self.plain = all(path == () for low, high, path in intervals)
+        # Runs of the class, for repeat()
+        self.pattern = re.compile(self.regex() + "*" if intervals else "")
+        self.bytesPattern = re.compile((self.regex(True) + "*").encode() if self.table != [None] * 256 else b"")
+    
+    def regex(self, binary=False):
+        """The class as a regex character class; over binary buffers only bytes count."""
+        if binary:
+            parts = "".join(f"\\x{low:02x}-\\x{min(high, 255):02x}" for low, high, path in self.intervals if low < 256)
+        else:
+            parts = "".join(f"\\U{low:08x}-\\U{high:08x}" for low, high, path in self.intervals)
+        return f"[{parts}]" if parts else "(?!)"
+    
+    @classmethod
+    def of(cls, definition, classes):
+        """The CharClass of definition, given those of its inners in classes, or None."""
+        if isinstance(definition, CharRangeDef):
+            ranges = [(ord(definition.left), ord(definition.right))]
+        elif isinstance(definition, CharSetDef):
+            ranges = cls._ranges(sorted(map(ord, definition.value)))
+        elif isinstance(definition, StringDef) and len(definition.value) == len(definition.encoded) == 1:
+            return cls([(ord(definition.value), ord(definition.value), ())])
+        elif isinstance(definition, DisjunctionDef) and all(inner in classes for inner in definition.inners):
+            inners = [classes[inner] for inner in definition.inners]
+            bounds = sorted({bound for inner in inners for low, high, path in inner.intervals for bound in (low, high + 1)})
+            intervals = []
+            for low, next in zip(bounds, bounds[1:]):
+                for i, inner in enumerate(inners):
+                    path = inner.lookup(low)
+                    if path is not None:
+                        path = (i,) + path
+                        if intervals and intervals[-1][1] == low - 1 and intervals[-1][2] == path:
+                            intervals[-1] = (intervals[-1][0], next - 1, path)
+                        else:
+                            intervals.append((low, next - 1, path))
+                        break
+            return cls(intervals)
+        else:
+            return None
+        if definition.inverted:
+            ranges = cls._complement(ranges)
+        return cls([(low, high, ()) for low, high in ranges])
+    
+    @staticmethod
+    def _ranges(codes):
+        ranges = []
+        for code in codes:
+            if ranges and ranges[-1][1] == code - 1:
+                ranges[-1] = (ranges[-1][0], code)
+            else:
+                ranges.append((code, code))
+        return ranges
+    
+    @classmethod
+    def _complement(cls, ranges):
+        result = []
+        low = 0
+        for start, end in ranges:
+            if start > low:
+                result.append((low, start - 1))
+            low = end + 1
+        if low <= cls.maxCode:
+            result.append((low, cls.maxCode))
+        return result
+    
+    def _search(self, code):
+        k = bisect.bisect_right(self.starts, code) - 1
+        if k >= 0 and code <= self.intervals[k][1]:
+            return self.intervals[k][2]
+        return None
+    
+    def lookup(self, code):
+        if code < 256:
+            return self.table[code]
+        return self._search(code)
+    
+    def match(self, buf, index, ctx):
+        if index >= ctx.reach:
+            ctx.reach = index + 1
+        if index >= len(buf):
+            path = None
+        else:
+            code = buf[index] if ctx.binary else ord(buf[index])
+            path = self.table[code] if code < 256 else self._search(code)
+        if path is None:
+            if index >= ctx.failure:
+                ctx.fail(index, self)
+            return None
+        return self._wrap(_newStringMatch(buf, index, index + 1), path), index + 1
+    
+    def _wrap(self, match, path):
+        for id in reversed(path):
+            outer = object.__new__(DisjunctionMatch)
+            outer.inner = match
+            outer.id = id
+            match = outer
+        return match
+    
+    def items(self, buf, start, end):
+        """The Matches of the single characters from start to end, all in the class."""
+        if self.plain:
+            return [_newStringMatch(buf, i, i + 1) for i in range(start, end)]
+        binary = not isinstance(buf, str)
+        return [self._wrap(_newStringMatch(buf, i, i + 1), self.lookup(buf[i] if binary else ord(buf[i])))
+                for i in range(start, end)]
+    
+    def repeat(self, buf, index, ctx, low, high):
+        """Match the class low to high (-1 for unbounded) times, scanning the run with a regex."""
+        end = len(buf) if high == -1 else min(len(buf), index + high)
+        stop = index
+        if index < end:
+            code = buf[index] if ctx.binary else ord(buf[index])
+            if (self.table[code] if code < 256 else self._search(code)) is not None:
+                stop = (self.bytesPattern if ctx.binary else self.pattern).match(buf, index, end).end()
+        if (high == -1 or stop < index + high) and stop >= ctx.reach:
+            ctx.reach = stop + 1
+        if stop - index < low:
+            if stop >= ctx.failure:
+                ctx.fail(stop, self)
+            return None
+        return RunMatch(buf, index, stop, self), stop
+
+
+class ElementRegex:
+    """Matches a regular ElementDef with one anchored regex; see GrammarAnalysis."""
+    
+    def __init__(self, element, pattern, bytesPattern):
+        self.element = element
+        self.pattern = pattern
+        self.bytesPattern = bytesPattern
+    
+    def match(self, buf, index, ctx):
+        found = (self.bytesPattern if ctx.binary else self.pattern).match(buf, index)
+        if found is None:
+            ctx.regular = False
+            try:
+                self.element._match(buf, index, ctx)
+            finally:
+                ctx.regular = True
+            return None
+        end = found.end()
+        return LazyElementMatch(self.element, buf, index, end), end
+
+
+class GrammarAnalysis:
+    """FIRST sets, nullability and the other properties of the grammar reachable from root."""
+    
+    maxRange = 256
+    maxRegex = 20000
+    
+    def __init__(self, root):
+        self.root = root
+        self.definitions = walk(root)
+        self.first = {}
+        self.nullable = {}
+        self.tables = {}
+        self._solve()
+        self._findRecursion()
+        self._findLeftRecursion()
+        self._findClasses()
+        self._findCuts()
+        self._findRegexes()
+    
+    def _solve(self):
+        for definition in self.definitions:
+            self.first[definition] = frozenset()
+            self.nullable[definition] = False
+        changed = True
+        while changed:
+            changed = False
+            for definition in reversed(self.definitions):
+                first, nullable = self._step(definition)
+                if first != self.first[definition] or nullable != self.nullable[definition]:
+                    self.first[definition] = first
+                    self.nullable[definition] = nullable
+                    changed = True
+    
+    def _step(self, definition):
+        if isinstance(definition, StringDef):
+            return frozenset(definition.value[:1]) | frozenset(definition.encoded[:1]), definition.value == ""
+        if isinstance(definition, CharRangeDef):
+            if definition.inverted or ord(definition.right) - ord(definition.left) >= self.maxRange:
+                return None, False
+            codes = range(ord(definition.left), ord(definition.right) + 1)
+            return frozenset(map(chr, codes)) | frozenset(e for e in codes if e < 256), False
+        if isinstance(definition, CharSetDef):
+            return (None if definition.inverted else definition.members), False
+        if isinstance(definition, ConcatenationDef):
+            first = frozenset()
+            for inner in definition.inners:
+                if first is not None:
+                    first = None if self.first[inner] is None else first | self.first[inner]
+                if not self.nullable[inner]:
+                    return first, False
+            return first, True
+        if isinstance(definition, DisjunctionDef):
+            firsts = [self.first[inner] for inner in definition.inners]
+            first = None if None in firsts else frozenset().union(*firsts)
+            return first, any(self.nullable[inner] for inner in definition.inners)
+        if isinstance(definition, RepetitionDef):
+            return self.first[definition.inner], self.nullable[definition.inner] or definition.range[0] == 0
+        if isinstance(definition, ElementDef):
+            if not definition.isDefined():
+                return frozenset(), False
+            return self.first[definition.definition], self.nullable[definition.definition]
+        if isinstance(definition, CutDef):
+            return frozenset(), True
+        return None, True
+    
+    def _findRecursion(self):
+        self.recursive = set()
+        for elem in self.definitions:
+            if isinstance(elem, ElementDef) and elem.isDefined() and elem in walk(elem.definition):
+                self.recursive.add(elem)
+        self.shallow = {definition: definition not in self.recursive for definition in self.definitions}
+        changed = True
+        while changed:
+            changed = False
+            for definition in reversed(self.definitions):
+                if self.shallow[definition] and not all(self.shallow[inner] for inner in definition.children()):
+                    self.shallow[definition] = False
+                    changed = True
+    
+    def _leftCalls(self, definition):
+        """The definitions that a match of definition can start by matching at the same index."""
+        if isinstance(definition, ConcatenationDef):
+            calls = []
+            for inner in definition.inners:
+                calls.append(inner)
+                if not self.nullable[inner]:
+                    break
+            return calls
+        if isinstance(definition, ElementDef):
+            return [definition.definition] if definition.isDefined() else []
+        return definition.children()
+    
+    def _findLeftRecursion(self):
+        calls = {definition: self._leftCalls(definition) for definition in self.definitions}
+        self.leaders = []
+        while True:
+            cycle = self._leftCycle(calls)
+            if cycle is None:
+                break
+            self.leaders.append(next(e for e in cycle if isinstance(e, ElementDef)))
+        reaches = {}
+        for definition in self.definitions:
+            seen = set()
+            stack = list(calls[definition])
+            while stack:
+                inner = stack.pop()
+                if inner not in seen:
+                    seen.add(inner)
+                    stack.extend(calls[inner])
+            reaches[definition] = seen
+        self.inLeftCycle = {definition for definition in self.definitions
+                            if any(leader is not definition and leader in reaches[definition] and definition in reaches[leader]
+                                   for leader in self.leaders)}
+    
+    def _leftCycle(self, calls):
+        """A cycle of left calls not broken by a leader, as a list, or None."""
+        state = {}
+        for root in self.definitions:
+            if root in state or root in self.leaders:
+                continue
+            path = [root]
+            state[root] = "open"
+            stack = [iter(calls[root])]
+            while stack:
+                inner = next(stack[-1], None)
+                if inner is None:
+                    state[path.pop()] = "done"
+                    stack.pop()
+                elif inner in self.leaders or state.get(inner) == "done":
+                    continue
+                elif state.get(inner) == "open":
+                    return path[path.index(inner):]
+                else:
+                    state[inner] = "open"
+                    path.append(inner)
+                    stack.append(iter(calls[inner]))
+        return None
+    
+    def _findClasses(self):
+        self.classes = {}
+        for definition in reversed(self.definitions):
+            charClass = CharClass.of(definition, self.classes)
+            if charClass is not None:
+                self.classes[definition] = charClass
+    
+    def _findCuts(self):
+        self.cuts = {definition for definition in self.definitions if isinstance(definition, CutDef)}
+        changed = bool(self.cuts)
+        while changed:
+            changed = False
+            for definition in reversed(self.definitions):
+                if definition not in self.cuts and any(inner in self.cuts for inner in definition.children()):
+                    self.cuts.add(definition)
+                    changed = True
+    
+    def _findRegexes(self):
+        self.regexes = {}
+        if not _atomicRegexes:
+            return
+        for elem in self.definitions:
+            if not (isinstance(elem, ElementDef) and elem.isDefined() and self.shallow[elem]):
+                continue
+            regex = self._regex(elem.definition, False)
+            bytesRegex = self._regex(elem.definition, True)
+            if regex is None or bytesRegex is None or len(regex) > self.maxRegex:
+                continue
+            self.regexes[elem] = ElementRegex(elem, re.compile(regex), re.compile(bytesRegex.encode()))
+    
+    def _regex(self, definition, binary):
+        """An equivalent regex for a shallow definition, or None if there's none."""
+        if definition in self.classes:
+            return self.classes[definition].regex(binary)
+        if isinstance(definition, StringDef):
+            if not definition.value:  # Like check(), the empty string only matches before the end of input
+                return r"(?=[\x00-\xff])" if binary else r"(?=[\s\S])"
+            if binary:
+                return "".join(f"\\x{byte:02x}" for byte in definition.encoded)
+            return re.escape(definition.value)
+        if isinstance(definition, ElementDef):
+            return self._regex(definition.definition, binary) if definition.isDefined() else None
+        parts = [self._regex(inner, binary) for inner in definition.children()]
+        if None in parts:
+            return None
+        if isinstance(definition, ConcatenationDef):
+            return "".join(f"(?>{part})" for part in parts)
+        if isinstance(definition, DisjunctionDef):
+            return f"(?>{'|'.join(parts)})"
+        if isinstance(definition, RepetitionDef):
+            low, high = definition.range
+            return f"(?>{parts[0]}){{{low},{'' if high == -1 else high}}}+"
+        return None
+    
+    def install(self):
+        for definition in self.definitions:
+            definition.shallow = self.shallow[definition]
+            definition.inLeftCycle = definition in self.inLeftCycle
+            if isinstance(definition, ElementDef):
+                definition.regex = self.regexes.get(definition)
+                definition.growsSeed = definition in self.leaders
+            if isinstance(definition, DisjunctionDef):
+                definition.charClass = self.classes.get(definition)
+                definition.cuts = definition in self.cuts
+            elif isinstance(definition, RepetitionDef):
+                definition.run = self.classes.get(definition.inner)
+                definition.cuts = definition in self.cuts
+        for definition in self.definitions:
+            if not isinstance(definition, DisjunctionDef):
+                continue
+            alternatives = list(enumerate(definition.inners))
+            always = tuple((i, inner) for i, inner in alternatives
+                           if self.first[inner] is None or self.nullable[inner])
+            if len(always) == len(alternatives):
+                definition.dispatch = None
+                continue
+            keys = frozenset().union(*[self.first[inner] for i, inner in alternatives if self.first[inner] is not None])
+            definition.dispatch = {key: tuple((i, inner) for i, inner in alternatives
+                                              if (i, inner) in always or key in self.first[inner])
+                                   for key in keys}
+            definition.fallback = always
+            self.tables[definition] = definition.dispatch
+        return self
+    
+    def describe(self):
+        lines = []
+        for definition in self.definitions:
+            if isinstance(definition, ElementDef) and definition.isDefined():
+                first = self.first[definition]
+                first = "any" if first is None else repr("".join(sorted(e for e in first if isinstance(e, str))))
+                lines.append(f"{definition}: first={first} nullable={self.nullable[definition]}"
+                             + (" left-recursive" if definition in self.leaders else ""))
+        return "\n".join(lines)
+
+
+class GrammarOptimizer:
+    """Rewrites the grammar reachable from root into a cheaper one that handlers can't tell apart."""
+    
+    def __init__(self, root, elements=None, tokens=()):
+        self.root = root
+        self.elements = elements
+        self.tokens = set(tokens)
+        self.changes = []
+        self.recursive = set()
+        self.observed = set()
+        self.rewritten = {}
+        self.hasCuts = False
+    
+    def run(self):
+        definitions = walk(self.root)
+        seen = set(definitions)
+        for elem in self.tokens:
+            for definition in walk(elem):
+                if definition not in seen:
+                    seen.add(definition)
+                    definitions.append(definition)
+        self.recursive = {elem for elem in definitions if isinstance(elem, ElementDef) and elem.isDefined()
+                          and elem in walk(elem.definition)}
+        self.hasCuts = any(isinstance(definition, CutDef) for definition in definitions)
+        stack = [elem.definition for elem in definitions
+                 if isinstance(elem, ElementDef) and elem.isDefined() and elem.handler is not _noHandler]
+        while stack:
+            definition = stack.pop()
+            if not isinstance(definition, ElementDef):
+                stack.extend(definition.children())
+            elif definition not in self.observed:
+                self.observed.add(definition)
+                if definition.isDefined():
+                    stack.append(definition.definition)
+        if self.elements is not None:
+            reachable = set(definitions)
+            dead = [name for name, elem in self.elements.items() if elem not in reachable]
+            for name in dead:
+                del self.elements[name]
+            if dead:
+                self.changes.append(f"dropped unreachable rules {', '.join(dead)}")
+        for elem in definitions:
+            if isinstance(elem, ElementDef) and elem.isDefined():
+                self._element(elem)
+        return self
+    
+    def report(self):
+        counts = {}
+        for change in self.changes:
+            counts[change] = counts.get(change, 0) + 1
+        return "\n".join(change if count == 1 else f"{change} ({count} times)" for change, count in counts.items()) or "no changes"
+    
+    def _inlinable(self, elem, transparent):
+        return elem is not self.root and elem.isDefined() and elem not in self.recursive and elem not in self.tokens \
+            and elem.handler is _noHandler and (transparent or elem.inline)
+    
+    def _element(self, elem):
+        """Rewrite elem's definition, once; returns the new one."""
+        if elem not in self.rewritten:
+            self.rewritten[elem] = elem.definition
+            transparent = elem.handler is _noHandler and (elem.inline or elem not in self.observed)
+            definition = self._rewrite(elem.definition, transparent, elem)
+            if definition is not elem.definition:
+                elem.define(definition)
+            self.rewritten[elem] = definition
+        return self.rewritten[elem]
+    
+    def _rewrite(self, definition, transparent, elem):
+        if isinstance(definition, ElementDef):
+            if self._inlinable(definition, transparent):
+                self.changes.append(f"inlined {definition} into {elem}")
+                return self._element(definition)
+            return definition
+        if isinstance(definition, RepetitionDef):
+            inner = self._rewrite(definition.inner, transparent, elem)
+            return definition if inner is definition.inner else RepetitionDef(inner, definition.range)
+        if not isinstance(definition, (ConcatenationDef, DisjunctionDef)):
+            return definition
+        inners = [self._rewrite(inner, transparent, elem) for inner in definition.inners]
+        if transparent:
+            nested = [inner for inner in inners if type(inner) is type(definition)
+                      and not (isinstance(inner, DisjunctionDef) and self._cuts(inner))]
+            if nested:
+                self.changes.append(f"flattened {len(nested)} nested {type(definition).__name__}s in {elem}")
+                inners = [item for inner in inners for item in (inner.inners if inner in nested else [inner])]
+            if isinstance(definition, ConcatenationDef):
+                inners = self._merge(inners, elem) if not self.tokens or elem in self.tokens else inners
+            elif not any(self._cuts(inner) for inner in inners):
+                inners = self._hoist(inners, elem)
+            if len(inners) == 1:
+                return inners[0]
+        if len(inners) == len(definition.inners) and all(a is b for a, b in zip(inners, definition.inners)):
+            return definition
+        return type(definition)(inners)
+    
+    def _cuts(self, definition):
+        return self.hasCuts and any(isinstance(inner, CutDef) for inner in walk(definition))
+    
+    def _merge(self, inners, elem):
+        """Join adjacent non-empty StringDefs of a concatenation."""
+        result = []
+        for inner in inners:
+            if isinstance(inner, StringDef) and inner.value and result and isinstance(result[-1], StringDef) and result[-1].value:
+                self.changes.append(f"merged {result[-1]} + {inner} in {elem}")
+                result[-1] = StringDef(result[-1].value + inner.value)
+            else:
+                result.append(inner)
+        return result
+    
+    def _hoist(self, inners, elem):
+        """Factor the first item shared by runs of consecutive alternatives out of them."""
+        result = []
+        k = 0
+        while k < len(inners):
+            head = self._head(inners[k])
+            j = k + 1
+            while head is not None and j < len(inners) and self._same(self._head(inners[j]), head):
+                j += 1
+            if j - k < 2:
+                result.append(inners[k])
+                k += 1
+                continue
+            self.changes.append(f"hoisted {head} out of {j - k} alternatives in {elem}")
+            tails = [inner.inners[1] if len(inner.inners) == 2 else ConcatenationDef(inner.inners[1:]) for inner in inners[k:j]]
+            rest = self._rewrite(DisjunctionDef(tails), True, elem)
+            result.append(ConcatenationDef([head] + (rest.inners if isinstance(rest, ConcatenationDef) else [rest])))
+            k = j
+        return result
+    
+    @staticmethod
+    def _head(definition):
+        if isinstance(definition, ConcatenationDef) and len(definition.inners) >= 2:
+            return definition.inners[0]
+        return None
+    
+    @staticmethod
+    def _same(a, b):
+        if a is b:
+            return True
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, StringDef):
+            return a.value == b.value
+        if isinstance(a, CharRangeDef):
+            return (a.left, a.right, a.inverted) == (b.left, b.right, b.inverted)
+        if isinstance(a, CharSetDef):
+            return (a.value, a.inverted) == (b.value, b.inverted)
+        return False
+
+
+class GrammarCompiler:
+    """Translates the grammar reachable from an ElementDef into Python source."""
+    
+    def __init__(self, root, binary=False):
+        self.root = root
+        self.binary = binary
+        self.elements = []
+        self.ids = {}
+        self.namespace = {}
+        self.counter = 0
+        self.source = None
+    
+    def compile(self):
+        self._collect(self.root)
+        lines = []
+        for elem in self.elements:
+            lines.extend(self._function(elem))
+        self.source = "\n".join(lines) + "\n"
+        self.namespace.update({"StringMatch": StringMatch, "ConcatenationMatch": ConcatenationMatch,
+                               "DisjunctionMatch": DisjunctionMatch, "ElementMatch": ElementMatch,
+                               "RunMatch": RunMatch, "LazyElementMatch": LazyElementMatch, "ONCE": (None,), "new": object.__new__, "UNEVALUATED": _UNEVALUATED,
+                               "grow": growSeed})
+        exec(compile(self.source, "<metaparser:compiled>", "exec"), self.namespace)
+        for elem in self.elements:
+            if self.binary:
+                elem.compiledBinary = self.namespace[f"f_{self.ids[elem]}"]
+            else:
+                elem.compiled = self.namespace[f"f_{self.ids[elem]}"]
+        return self
+    
+    def _collect(self, root):
+        for definition in walk(root):
+            if isinstance(definition, ElementDef) and definition.isDefined():
+                self.ids[definition] = len(self.elements)
+                self.elements.append(definition)
+                self.namespace[f"E_{self.ids[definition]}"] = definition
+    
+    def _var(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+    
+    def _const(self, value):
+        name = self._var("K")
+        self.namespace[name] = value
+        return name
+    
+    def _function(self, elem):
+        n = self.ids[elem]
+        lines = [f"def f_{n}(buf, index, ctx):",
+                 f"    # {elem.name}"]
+        if elem.growsSeed:
+            lines += [f"    return grow(E_{n}, g_{n}, buf, index, ctx)",
+                      "",
+                      f"def g_{n}(buf, index, ctx):"]
+        if elem.regex is not None:
+            pattern = elem.regex.bytesPattern if self.binary else elem.regex.pattern
+            lines += ["    if ctx.regular:",  # ElementRegex.match(), inlined
+                      f"        found = {self._const(pattern.match)}(buf, index)",
+                      "        if found is None:",
+                      "            ctx.regular = False",
+                      "            try:",
+                      f"                f_{n}(buf, index, ctx)",
+                      "            finally:",
+                      "                ctx.regular = True",
+                      "            return None",
+                      "        end = found.end()",
+                      "        match = new(LazyElementMatch)",
+                      f"        match.definition = E_{n}",
+                      "        match.region = (buf, index, end)",
+                      "        match.cache = None",
+                      "        match.lookahead = None",
+                      "        match.shift = 0",
+                      "        match.result = UNEVALUATED",
+                      "        return match, end"]
+        lines += ["    L = len(buf)",
+                  "    plain = ctx.plain",
+                  "    i = index"]
+        result = self._emit(elem.definition, lines, 1, "return None")
+        lines += ["    match = new(ElementMatch)",
+                  f"    match.inner = {result}",
+                  f"    match.definition = E_{n}",
+                  "    match.lookahead = None",
+                  "    match.shift = 0",
+                  "    match.result = UNEVALUATED",
+                  "    return match, i",
+                  ""]
+        return lines
+    
+    def _guard(self, definition, k, start):
+        """Conditions under which alternative k of a disjunction starting at index start can match."""
+        if definition.dispatch is None or any(i == k for i, inner in definition.fallback):
+            return []
+        keys = frozenset(key for key, candidates in definition.dispatch.items() if any(i == k for i, inner in candidates))
+        return [f"{start} < L", f"buf[{start}] in {self._const(keys)}"]
+    
+    def _charCond(self, definition, negate=False):
+        """Condition under which buf[i] matches (or with negate, doesn't) a CharRangeDef or CharSetDef."""
+        if isinstance(definition, CharRangeDef) and self.binary:
+            cond = f"{ord(definition.left)} <= buf[i] <= {ord(definition.right)}"
+        elif isinstance(definition, CharRangeDef):
+            cond = f"{definition.left!r} <= buf[i] <= {definition.right!r}"
+        else:
+            cond = f"buf[i] in {self._const(definition.members)}"
+        return f"not ({cond})" if definition.inverted != negate else f"({cond})"
+    
+    def _emit(self, definition, lines, depth, fail):
+        """Append code matching definition at i, which executes fail if it fails; returns the result variable."""
+        pad = "    " * depth
+        var = self._var("r")
+        if isinstance(definition, StringDef):
+            value = definition.encoded if self.binary else definition.value
+            if len(value) == 1:
+                lines.append(f"{pad}if i >= L or buf[i] != {value[0]!r}:")
+            elif value:
+                lines.append(f"{pad}if buf[i:i + {len(value)}] != {value!r}:")
+            else:
+                lines.append(f"{pad}if i >= L:")
+            lines += [f"{pad}    if i + {max(len(value), 1)} > ctx.reach:",
+                      f"{pad}        ctx.reach = i + {max(len(value), 1)}",
+                      f"{pad}    if i >= ctx.failure:",
+                      f"{pad}        ctx.fail(i, {self._const(definition)})",
+                      f"{pad}    {fail}",
+                      f"{pad}{var} = new(StringMatch)",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = i",
+                      f"{pad}i += {len(value)}",
+                      f"{pad}{var}.end = i"]
+        elif isinstance(definition, (CharRangeDef, CharSetDef)):
+            lines += [f"{pad}if i >= L or {self._charCond(definition, negate=True)}:",
+                      f"{pad}    if i >= ctx.reach:",
+                      f"{pad}        ctx.reach = i + 1",
+                      f"{pad}    if i >= ctx.failure:",
+                      f"{pad}        ctx.fail(i, {self._const(definition)})",
+                      f"{pad}    {fail}",
+                      f"{pad}{var} = new(StringMatch)",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = i",
+                      f"{pad}i += 1",
+                      f"{pad}{var}.end = i"]
+        elif isinstance(definition, ConcatenationDef):
+            start = self._var("i")
+            lines.append(f"{pad}{start} = i")
+            inners = [self._emit(inner, lines, depth, fail) for inner in definition.inners]
+            lines += [f"{pad}{var} = new(ConcatenationMatch)",
+                      f"{pad}{var}.inners = [{', '.join(inners)}]",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = {start}",
+                      f"{pad}{var}.end = i"]
+        elif isinstance(definition, DisjunctionDef) and definition.charClass is not None:
+            lines += [f"{pad}{var} = {self._const(definition.charClass)}.match(buf, i, ctx)",
+                      f"{pad}if {var} is None:",
+                      f"{pad}    {fail}",
+                      f"{pad}{var}, i = {var}"]
+        elif isinstance(definition, RepetitionDef) and definition.run is not None and isinstance(definition.inner, (CharRangeDef, CharSetDef)):
+            low, high = definition.range
+            start, end = self._var("i"), self._var("e")
+            lines += [f"{pad}{start} = i",
+                      f"{pad}{end} = {'L' if high == -1 else f'min(L, i + {high})'}",
+                      f"{pad}if i < {end} and {self._charCond(definition.inner)}:",
+                      f"{pad}    i = {self._const(definition.run.bytesPattern if self.binary else definition.run.pattern)}.match(buf, i, {end}).end()"]
+            lines += [f"{pad}if {'' if high == -1 else f'i - {start} < {high} and '}i >= ctx.reach:",
+                      f"{pad}    ctx.reach = i + 1"]
+            if low > 0:
+                lines += [f"{pad}if i - {start} < {low}:",
+                          f"{pad}    if i >= ctx.failure:",
+                          f"{pad}        ctx.fail(i, {self._const(definition.run)})",
+                          f"{pad}    {fail}"]
+            lines += [f"{pad}{var} = new(RunMatch)",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = {start}",
+                      f"{pad}{var}.end = i",
+                      f"{pad}{var}.charClass = {self._const(definition.run)}",
+                      f"{pad}{var}.cache = None"]
+        elif isinstance(definition, RepetitionDef) and definition.run is not None:
+            lines += [f"{pad}{var} = {self._const(definition.run)}.repeat(buf, i, ctx, {definition.range[0]}, {definition.range[1]})",
+                      f"{pad}if {var} is None:",
+                      f"{pad}    {fail}",
+                      f"{pad}{var}, i = {var}"]
+        elif isinstance(definition, CutDef):
+            lines += [f"{pad}ctx.cut = True",
+                      f"{pad}if not ctx.open:",
+                      f"{pad}    ctx.commit(i)",
+                      f"{pad}{var} = new(StringMatch)",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = i",
+                      f"{pad}{var}.end = i"]
+        elif isinstance(definition, DisjunctionDef):
+            start, outer = self._var("i"), self._var("c")
+            lines += [f"{pad}{start} = i",
+                      f"{pad}{var} = None"]
+            if definition.cuts:
+                lines.append(f"{pad}{outer} = ctx.choice()")
+            if definition.dispatch is not None:
+                lines += [f"{pad}if i >= ctx.reach:",
+                          f"{pad}    ctx.reach = i + 1"]
+            for k, inner in enumerate(definition.inners):
+                level = depth
+                guard = self._guard(definition, k, start)
+                if k > 0 or guard:
+                    pending = ([f"{var} is None"] + (["not ctx.cut"] if definition.cuts else [])) if k > 0 else []
+                    lines.append(f"{pad}if {' and '.join(pending + guard)}:")
+                    level += 1
+                lines.append("    " * level + "for _ in ONCE:")
+                if k > 0:
+                    lines.append("    " * (level + 1) + f"i = {start}")
+                result = self._emit(inner, lines, level + 1, "break")
+                lines += ["    " * (level + 1) + f"{var} = new(DisjunctionMatch)",
+                          "    " * (level + 1) + f"{var}.inner = {result}",
+                          "    " * (level + 1) + f"{var}.id = {k}"]
+            if definition.cuts:
+                lines.append(f"{pad}ctx.endChoice({outer})")
+            lines.append(f"{pad}if {var} is None:")
+            if definition.dispatch is not None:
+                lines += [f"{pad}    if {start} >= ctx.failure:",
+                          f"{pad}        ctx.fail({start}, {self._const(definition)})"]
+            lines.append(f"{pad}    {fail}")
+        elif isinstance(definition, RepetitionDef):
+            low, high = definition.range
+            items, first, start, outer = self._var("l"), self._var("i"), self._var("i"), self._var("c")
+            lines += [f"{pad}{first} = i",
+                      f"{pad}{items} = []"]
+            if definition.cuts:
+                lines.append(f"{pad}{outer} = ctx.choice()")
+            lines += [f"{pad}while {'True' if high == -1 else f'len({items}) < {high}'}:",
+                      f"{pad}    {start} = i",
+                      f"{pad}    for _ in ONCE:"]
+            result = self._emit(definition.inner, lines, depth + 2, "break")
+            lines += [f"{pad}    else:",
+                      f"{pad}        {items}.append({result})"]
+            if definition.cuts:
+                lines.append(f"{pad}        ctx.cut = False")
+            lines += [f"{pad}        continue",
+                      f"{pad}    i = {start}",
+                      f"{pad}    break"]
+            if definition.cuts:
+                lines += [f"{pad}if ctx.endChoice({outer}):",
+                          f"{pad}    {fail}"]
+            if low > 0:
+                lines += [f"{pad}if len({items}) < {low}:",
+                          f"{pad}    {fail}"]
+            lines += [f"{pad}{var} = new(ConcatenationMatch)",
+                      f"{pad}{var}.inners = {items}",
+                      f"{pad}{var}.buf = buf",
+                      f"{pad}{var}.start = {first}",
+                      f"{pad}{var}.end = i"]
+        else:
+            if definition in self.ids:
+                n = self.ids[definition]
+                lines += [f"{pad}if plain:",
+                          f"{pad}    {var} = f_{n}(buf, i, ctx)",
+                          f"{pad}else:",
+                          f"{pad}    {var} = E_{n}.match(buf, i, ctx)"]
+            else:
+                lines.append(f"{pad}{var} = {self._const(definition)}.match(buf, i, ctx)")
+            lines += [f"{pad}if {var} is None:",
+                      f"{pad}    {fail}",
+                      f"{pad}{var}, i = {var}"]
+        return var
+
+
+class Lexer:
+    """Splits the input into tokens in one pass, for grammars that declare them; see AbstractParser.tokens."""
+    
+    def __init__(self, analysis, tokens=(), skip=(), rules=None):
+        elements = dict(rules or {})
+        elements.update((d.name, d) for d in analysis.definitions if isinstance(d, ElementDef))
+        self.tokens = [self._resolve(token, elements) for token in tokens]
+        self.skip = [self._resolve(token, elements) for token in skip]
+        self.firsts = {}
+        if not _atomicRegexes:
+            raise ParserError("Tokens need Python 3.11 or later, which can match them with regexes")
+        for elem in self.tokens + self.skip:
+            if not elem.isDefined():
+                raise UndefinedElementError(f"Token {elem.name} isn't defined")
+            # Skip elements in particular are usually not part of the grammar proper
+            self.firsts[elem] = (analysis if elem in analysis.first else GrammarAnalysis(elem).install()).first[elem]
+            if elem.regex is None:
+                raise ParserError(f"Token {elem.name} isn't regular")
+        self.kinds = self.tokens + self.skip  # The kind of code k is an ElementDef or a literal's text
+        self.literals = {}
+        self.proxies = {}
+        self.origins = {}
+        pending = []
+        self.main = self._proxy(analysis.root, pending)
+        while pending:
+            elem = pending.pop()
+            proxy = self.proxies[elem]
+            if elem in self.tokens:
+                proxy.define(StringDef(chr(self.kinds.index(elem))))
+            elif elem in self.skip:
+                proxy.define(ConcatenationDef([]))
+            elif elem.isDefined():
+                proxy.define(self._rewrite(elem.definition, elem, pending))
+        self.analysis = GrammarAnalysis(self.main).install()
+        for proxy, elem in self.origins.items():
+            if elem not in self.tokens and elem not in self.skip:
+                # Matches of the rest are translated from their own trees, which a regex doesn't build
+                proxy.regex = None
+        self.names = [repr(kind) if isinstance(kind, str) else str(kind) for kind in self.kinds]
+        self.skipped = {chr(k) for k in range(len(self.tokens), len(self.tokens) + len(self.skip))}
+        self.tables = {binary: self._table(binary) for binary in (False, True)}
+    
+    @staticmethod
+    def _resolve(token, elements):
+        if isinstance(token, ElementDef):
+            return token
+        if token not in elements:
+            raise ParserError(f"Token {token} isn't a rule of the grammar")
+        return elements[token]
+    
+    def _proxy(self, elem, pending):
+        if elem not in self.proxies:
+            proxy = self.proxies[elem] = ElementDef(elem.name, elem.handler)
+            proxy.span = elem.span
+            self.origins[proxy] = elem
+            pending.append(elem)
+        return self.proxies[elem]
+    
+    def _literal(self, text):
+        if text not in self.literals:
+            self.literals[text] = chr(len(self.kinds))
+            self.kinds.append(text)
+        return self.literals[text]
+    
+    def _rewrite(self, definition, elem, pending):
+        if isinstance(definition, ElementDef):
+            return self._proxy(definition, pending)
+        if isinstance(definition, StringDef):
+            return StringDef(self._literal(definition.value) if definition.value else "")
+        if isinstance(definition, CharSetDef) and not definition.inverted:
+            return CharSetDef([self._literal(char) for char in definition.value])
+        if isinstance(definition, CharRangeDef) and not definition.inverted \
+                and ord(definition.right) - ord(definition.left) < GrammarAnalysis.maxRange:
+            return CharSetDef([self._literal(chr(code)) for code in range(ord(definition.left), ord(definition.right) + 1)])
+        if isinstance(definition, (ConcatenationDef, DisjunctionDef)):
+            return type(definition)([self._rewrite(inner, elem, pending) for inner in definition.inners])
+        if isinstance(definition, RepetitionDef):
+            return RepetitionDef(self._rewrite(definition.inner, elem, pending), definition.range)
+        if isinstance(definition, CutDef):
+            return definition
+        raise ParserError(f"{definition} in {elem} can't match tokens; it belongs in a token")
+    
+    def _table(self, binary):
+        """Dispatch table from the first character of a token to the kinds it can be, and the kinds for any other."""
+        candidates = []
+        for k, kind in sorted(enumerate(self.kinds), key=lambda item: not isinstance(item[1], str)):
+            if isinstance(kind, str):
+                literal = kind.encode(StringDef.encoding) if binary else kind
+                candidates.append(((chr(k), literal, None), frozenset([literal[0]])))
+            else:
+                candidates.append(((chr(k), None, kind.regex.bytesPattern if binary else kind.regex.pattern),
+                                   self.firsts[kind]))
+        keys = frozenset().union(*[first for candidate, first in candidates if first is not None])
+        dispatch = {key: tuple(candidate for candidate, first in candidates if first is None or key in first) for key in keys}
+        return dispatch, tuple(candidate for candidate, first in candidates if first is None)
+    
+    def tokenize(self, buf):
+        """Split buf into tokens; returns their kinds, starts and ends, and where tokenizing stopped."""
+        dispatch, fallback = self.tables[not isinstance(buf, str)]
+        skipped = self.skipped
+        kinds = []
+        starts = array.array("q")
+        ends = array.array("q")
+        index = 0
+        size = len(buf)
+        while index < size:
+            best = index
+            for kind, literal, pattern in dispatch.get(buf[index], fallback):
+                if pattern is None:
+                    end = index + len(literal)
+                    if end <= best or buf[index:end] != literal:
+                        continue
+                else:
+                    found = pattern.match(buf, index)
+                    if found is None or found.end() <= best:
+                        continue
+                    end = found.end()
+                best = end
+                chosen = kind
+            if best == index:
+                break
+            if chosen not in skipped:
+                kinds.append(chosen)
+                starts.append(index)
+                ends.append(best)
+            index = best
+        return "".join(kinds), starts, ends, index
+    
+    def expected(self, buf, index):
+        """Names of the tokens that could have started at index, where tokenizing stopped."""
+        dispatch, fallback = self.tables[not isinstance(buf, str)]
+        return sorted({self.names[ord(kind)] for kind, literal, pattern in dispatch.get(buf[index], fallback)
+                       if kind not in self.skipped})
+    
+    def failure(self, buf, index):
+        """A ParseContext noting how far the tokens and skip elements that could start at index got there."""
+        dispatch, fallback = self.tables[not isinstance(buf, str)]
+        ctx = ParseContext(binary=not isinstance(buf, str), regular=False)
+        for kind, literal, pattern in dispatch.get(buf[index], fallback):
+            if pattern is not None:
+                self.kinds[ord(kind)].match(buf, index, ctx)
+        return ctx
+    
+    def describe(self, definition, found):
+        """Like _expectations(), for a definition of main and the code of the token kind found."""
+        if definition is None:
+            return ["end of input"]
+        if isinstance(definition, ElementDef):
+            return [str(definition)]
+        if isinstance(definition, StringDef):
+            codes = {ord(char) for char in definition.value}
+        elif isinstance(definition, CharSetDef):
+            codes = {ord(char) for char in definition.value}
+        elif isinstance(definition, CharClass):
+            codes = {code for low, high, path in definition.intervals for code in range(low, high + 1)}
+        elif isinstance(definition, DisjunctionDef):
+            codes = {key if isinstance(key, int) else ord(key) for key in definition.dispatch} - {found}
+        else:
+            return [str(definition)]
+        return [self.names[code] for code in codes]
+    
+    def restore(self, root, kinds, buf, starts, ends):
+        """Turn a Match tree over the token kinds of buf into the one over buf itself, in place."""
+        count = len(starts)
+        origins = self.origins
+        stack = [root]
+        while stack:
+            match = stack.pop()
+            kind = type(match)
+            if kind is StringMatch or kind is ConcatenationMatch or kind is RunMatch:
+                if match.buf is kinds:
+                    if kind is not StringMatch:
+                        stack.extend(match.inners)
+                    start = starts[match.start] if match.start < count else len(buf)
+                    match.end = ends[match.end - 1] if match.end > match.start else start
+                    match.start = start
+                    match.buf = buf
+            elif kind is DisjunctionMatch:
+                stack.append(match.inner)
+            elif match.definition in origins:
+                match.definition = origins[match.definition]
+                if isinstance(match, LazyElementMatch):
+                    index = match.region[1]
+                    if match.region[2] == index:
+                        # A skip element
+                        start = starts[index] if index < count else len(buf)
+                        match.region = (buf, start, start)
+                        match.cache = _newStringMatch(buf, start, start)
+                    else:
+                        match.region = (buf, starts[index], ends[index])
+                else:
+                    stack.append(match.inner)
+        return root
+
+
 digits = CharRangeDef("0", "9")
 hexdigits = CharSetDef("0123456789abcdef")
 alphaLower = CharRangeDef("a", "z")
@@ -329,55 +2382,633 @@ class AbstractParser:
     bufferType = str
     mainElement = None
     defined = False
+    analysis = None
+    handlersOrigin = None  # (path, handlersClass) of a .bbnf grammar's handlers, to rebuild it elsewhere
+    rules = None  # The named ElementDefs of a .bbnf grammar
+    optimizer = None
+    tokens = ()  # ElementDefs (or their names) a Lexer splits the input into before parsing
+    skip = ()  # ElementDefs (or names) whose matches the Lexer drops between tokens
+    lexer = None
     
-    def __init__(self):
-        if not self.defined:
-            self.mainElement = self.define()
-            self.defined = True
+    def __init__(self, streaming=False, hook=None):
+        self.streaming = streaming
+        self.hook = hook
+        self.prepare()
         self.clear()
     
     @classmethod
     def define(cls):
         pass
     
+    @classmethod
+    def prepare(cls):
+        """Define and analyse the grammar once for the whole class, if not done yet."""
+        if cls.defined and cls.analysis is not None and cls.analysis.root is cls.mainElement:
+            return
+        with _grammarLock:
+            if not cls.defined:
+                cls.mainElement = cls.define()
+                cls.defined = True
+            if cls.analysis is None or cls.analysis.root is not cls.mainElement:
+                cls._analyse()
+    
+    @classmethod
+    def _analyse(cls):
+        cls.analysis = GrammarAnalysis(cls.mainElement).install()
+        cls.lexer = Lexer(cls.analysis, cls.tokens, cls.skip, cls.rules) if cls.tokens or cls.skip else None
+    
+    @classmethod
+    def compile(cls):
+        """Replace interpretation of the grammar with generated Python code; returns the GrammarCompiler."""
+        with _grammarLock:
+            cls.prepare()
+            if cls.lexer is not None:
+                return GrammarCompiler(cls.lexer.main).compile()
+            return GrammarCompiler(cls.mainElement, binary=not issubclass(cls.bufferType, str)).compile()
+    
+    @classmethod
+    def optimize(cls):
+        """Run a GrammarOptimizer over the grammar, once, and return it; call it before compile()."""
+        with _grammarLock:
+            cls.prepare()
+            if cls.optimizer is None or cls.optimizer.root is not cls.mainElement:
+                tokens = cls.lexer.tokens + cls.lexer.skip if cls.lexer is not None else ()
+                optimizer = GrammarOptimizer(cls.mainElement, cls.rules, tokens).run()
+                cls._analyse()
+                cls.optimizer = optimizer
+            return cls.optimizer
+    
+    @classmethod
+    def parseText(cls, text, **parseArgs):
+        """Parse text with a parser of its own and return its value; parseArgs are passed on to parse()."""
+        parser = cls()
+        parser.feed(text)
+        return parser.parse(**parseArgs)
+    
+    @classmethod
+    async def parseTextAsync(cls, text, every=10000, offload=False, executor=None, **parseArgs):
+        """parseText() for asyncio; every, offload and executor are as for parseAsync()."""
+        if offload or executor is not None:
+            import asyncio  # See _cooperate()
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(cls.parseText, text, **parseArgs))
+        parser = cls()
+        parser.feed(text)
+        return await parser.parseAsync(every, **parseArgs)
+    
     def feed(self, data):
-        self.buf += data
+        if self.streaming:
+            if self._queue(data):
+                self._resume()
+        elif self.reusable is not None:
+            self.edit(len(self.buf), len(self.buf), data)
+        else:
+            self.buf += data
+    
+    def _queue(self, data):
+        """Add data to the chunks a streaming parse hasn't joined yet; True once it's time to resume it."""
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        return self.pendingSize >= (len(self.buf) if self.pinned else len(self.buf) - self.pos)
+    
+    async def feedAsync(self, source, chunkSize=65536, every=10000):
+        """feed() everything read from source, an asyncio.StreamReader or an async iterable of chunks."""
+        async for chunk in _chunks(source, chunkSize, issubclass(self.bufferType, str)):
+            if self.streaming and self._queue(chunk):
+                await _cooperate(self._advance(False, every))
+            elif not self.streaming:
+                self.feed(chunk)
     
     def clear(self):
+        if isinstance(getattr(self, "buf", None), mmap.mmap):
+            self.buf.close()  # Mapped by mapFile()
         self.buf = self.bufferType()
+        self.tree = None
+        self.reusable = None
+        self.pending = []
+        self.pendingSize = 0
+        self.offset = 0
+        self.lines = 0
+        self.lineStart = 0
+        self.pos = 0
+        self.pinned = False
+        self.parts = []
+        self.items = []
+        self.count = 0
+        self.ready = []
+        self.recordPart = None
+        self.streamCtx = None
+        if self.streaming:
+            self.streamCtx = ParseContext("bounded", None, binary=not issubclass(self.bufferType, str), hook=self.hook,
+                                          regular=False)
+    
+    def mapFile(self, path):
+        """Use the file at path as the buffer through a read-only mmap, and return it."""
+        if issubclass(self.bufferType, str):
+            raise ParserError("Mapping a file requires a binary bufferType")
+        self.clear()
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return contextlib.nullcontext()
+            self.buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.buf
+    
+    def _resume(self, final=False):
+        """Advance a streaming parse as far as the buffered input allows."""
+        return _finish(self._advance(final))
+    
+    def _advance(self, final, every=None):
+        """_resume() as a generator of steps, yielding every `every` match steps (see matchSteps())."""
+        if self.pending:
+            self.streamCtx.forget(len(self.buf))
+            self.buf += self.bufferType().join(self.pending)
+            self.pending = []
+            self.pendingSize = 0
+            self.pinned = False
+        main = self.mainElement
+        if main.growsSeed:
+            parts = [main]
+        elif isinstance(main.definition, ConcatenationDef):
+            parts = main.definition.inners
+        else:
+            parts = [main.definition]
+        while len(self.parts) < len(parts):
+            part = parts[len(self.parts)]
+            if isinstance(part, RepetitionDef):
+                low, high = part.range
+                items = self.ready if part is self.recordPart else self.items
+                while high == -1 or self.count < high:
+                    result = yield from self._step(part.inner, final, every)
+                    if result is False:
+                        return None
+                    if result is None:
+                        break
+                    items.append(result)
+                    self.count += 1
+                    self.pinned = self.pinned or items is self.items
+                    self._release()
+                if self.count < low:
+                    raise self._matchError(self.streamCtx)
+                result = ConcatenationMatch(self.items)
+                self.items = []
+                self.count = 0
+            else:
+                result = yield from self._step(part, final, every)
+                if result is False:
+                    return None
+                if result is None:
+                    raise self._matchError(self.streamCtx)
+                self.pinned = True
+            self.parts.append(result)
+        if not final:
+            return None
+        if self.pos != len(self.buf):
+            raise self._matchError(self.streamCtx, self.pos)
+        if main.growsSeed:
+            return self.parts[0]
+        inner = ConcatenationMatch(self.parts) if isinstance(main.definition, ConcatenationDef) else self.parts[0]
+        return ElementMatch(inner, main)
+    
+    def _step(self, definition, final, every=None):
+        """Match one final piece at self.pos, as a generator of steps; False means wait for more input."""
+        ctx = self.streamCtx
+        ctx.reach = self.pos
+        if every:
+            result = yield from matchSteps(definition, self.buf, self.pos, ctx, every)
+        else:
+            result = definition.match(self.buf, self.pos, ctx)
+        if not final and ctx.reach > len(self.buf):
+            return False
+        if result is None:
+            return None
+        self.pos = result[1]
+        return result[0]
     
-    def parse(self):
+    def _release(self):
+        """Drop the buffer prefix behind self.pos once it's most of the buffer, unless the buffer is pinned."""
+        if self.pinned or self.pos <= len(self.buf) // 2:
+            self.streamCtx.commit(self.pos)
+            return
+        newline = "\n" if isinstance(self.buf, str) else b"\n"
+        lines = self.buf.count(newline, 0, self.pos)
+        if lines:
+            self.lines += lines
+            self.lineStart = self.offset + self.buf.rfind(newline, 0, self.pos) + 1
+        self.buf = self.buf[self.pos:]
+        self.offset += self.pos
+        self.pos = 0
+        ctx = self.streamCtx
+        self.streamCtx = ParseContext("bounded", None, binary=ctx.binary, hook=ctx.hook, regular=False)
+    
+    def edit(self, start, end, replacement):
+        """Replace buf[start:end] with replacement, keeping the matches outside it for an incremental parse."""
+        if self.streaming:
+            raise ParserError("Streaming parsers can't be edited")
+        if not 0 <= start <= end <= len(self.buf):
+            raise ValueError("Edit range must lie within the buffer")
+        delta = len(replacement) - (end - start)
+        self.buf = self.buf[:start] + replacement + self.buf[end:]
+        if self.reusable is None:
+            return
+        kept = []
+        stack = list(self.reusable)
+        while stack:
+            match, position = stack.pop()
+            if isinstance(match, RepeatMatch):
+                base = position - match.start
+                first = bisect.bisect_right(match.ends, start - base)
+                if first and max(match.lookaheads[:first]) > start - base:  # An item looked further ahead than the next one
+                    first = next(k for k, lookahead in enumerate(match.lookaheads) if lookahead > start - base)
+                last = max(first, bisect.bisect_left(match.starts, end - base))
+                if match.definition.inLeftCycle:  # Its runs can't be taken over, so only the items' insides can be reused
+                    first, last = 0, len(match.inners)
+                if first:
+                    kept.append((match.slice(0, first), position))
+                if last < len(match.inners):
+                    kept.append((match.slice(last, len(match.inners)), base + match.starts[last] + delta))
+                for item, itemStart in zip(match.inners[first:last], match.starts[first:last]):
+                    stack.extend([(item, base + itemStart)] if isinstance(item, ElementMatch) else _parts(item, base + itemStart))
+            elif match.lookahead is None:  # Left-recursive elements bypass the memo, so only their insides can be reused
+                stack.extend(_parts(match, position))
+            elif position + match.lookahead - match.start <= start:
+                kept.append((match, position))
+            elif position >= end:
+                kept.append((match, position + delta))
+                if position == end:
+                    stack.extend(_parts(match, position))
+            else:
+                stack.extend(_parts(match, position))
+        self.reusable = kept
+    
+    def parse(self, memo=None, window=4096, incremental=False, engine="auto", eager=False, profile=None):
+        """Match the fed buffer against the main element and evaluate it."""
+        return _finish(self._parse(memo, window, incremental, engine, eager, profile))
+    
+    async def parseAsync(self, every=10000, offload=False, executor=None, **parseArgs):
+        """parse() for asyncio; parseArgs are passed on to it."""
+        if offload or executor is not None:
+            import asyncio  # See _cooperate()
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(self.parse, **parseArgs))
+        return await _cooperate(self._parse(every=every, **parseArgs))
+    
+    def _parse(self, memo=None, window=4096, incremental=False, engine="auto", eager=False, profile=None, every=None):
+        """parse() as a generator of steps, yielding every `every` steps of the iterative engine if given."""
+        if engine not in ("auto", "recursive", "iterative"):
+            raise ValueError("Engine must be 'auto', 'recursive' or 'iterative'")
+        if eager and (self.streaming or incremental):
+            raise ParserError("Eager evaluation needs a plain parse")
+        if profile is not None and self.streaming:
+            raise ParserError("Streaming parsers are profiled through their hook")
         assert self.defined
-        match, index = self.mainElement.match(self.buf, 0)
+        hook = self.hook if profile is None else profile
+        if self.lexer is not None:
+            if self.streaming or incremental or eager:
+                raise ParserError("Grammars with tokens need a plain parse")
+            return (yield from self._parseTokens(memo, window, engine, profile, every))
+        if self.streaming:
+            match = yield from self._advance(True, every)
+            self.memoStats = self.streamCtx.stats()
+            return (yield from self._evaluate(match, "auto", every))
+        if incremental:
+            ctx = ParseContext(memo or "bounded", window if memo else None, binary=not isinstance(self.buf, str), hook=hook,
+                               regular=False)
+            ctx.runs = {}
+            reusable = list(self.reusable or ())
+            while reusable:
+                match, position = reusable.pop()
+                if isinstance(match, RepeatMatch) and match.definition.inLeftCycle:
+                    base = position - match.start
+                    for item, itemStart in zip(match.inners, match.starts):
+                        reusable.extend([(item, base + itemStart)] if isinstance(item, ElementMatch) else _parts(item, base + itemStart))
+                    continue
+                if isinstance(match, RepeatMatch):
+                    base = position - match.start
+                    shifted = (lambda indices: indices) if not base else (lambda indices: [i + base for i in indices])
+                    ctx.runs.setdefault(match.definition, []).append(
+                        (shifted(match.starts), match.inners, shifted(match.ends), shifted(match.lookaheads)))
+                    continue
+                if match.lookahead is None:
+                    reusable.extend(_parts(match, position))
+                    continue
+                match.shift = position - match.start
+                ctx.seed(match.definition, position, (match, position + match.end - match.start),
+                         position + match.lookahead - match.start)
+            for definition, runs in ctx.runs.items():
+                runs.sort(key=lambda run: run[0][0])
+                ctx.runs[definition] = ([run[0][0] for run in runs], runs)
+        else:
+            ctx = ParseContext(memo, window, binary=not isinstance(self.buf, str), hook=hook, eager=eager,
+                               regular=profile is None)
+        result, engine = yield from self._matchSteps(self.mainElement, self.buf, 0, ctx, engine, every)
+        self.memoStats = ctx.stats()
+        if result is None:
+            raise self._exactError(ctx, [(self.mainElement, 0)], memo, window)
+        match, index = result
+        if index != len(self.buf):
+            raise self._exactError(ctx, [(self.mainElement, 0)], memo, window, index)
+        if incremental:
+            self.tree = match
+            self.reusable = [(match, 0)]
         dbg("general", match, index)
-        assert index == len(self.buf)
-        return match.evaluate()
+        return (yield from self._evaluate(match, engine, every))
+    
+    def _parseTokens(self, memo, window, engine, profile=None, every=None):
+        """parse() for grammars with tokens: the Lexer's grammar matches the kinds of the tokens of the buffer."""
+        kinds, starts, ends, stop = self.lexer.tokenize(self.buf)
+        if stop != len(self.buf):
+            failure = self.lexer.failure(self.buf, stop)
+            if failure.failure > stop:  # Inside a token or skipped text
+                raise self._matchError(failure)
+            raise self._errorAt(stop, self.lexer.expected(self.buf, stop), repr(self._slice(stop, stop + 1)))
+        ctx = ParseContext(memo, window, hook=self.hook if profile is None else profile, regular=profile is None)
+        result, engine = yield from self._matchSteps(self.lexer.main, kinds, 0, ctx, engine, every)
+        self.memoStats = ctx.stats()
+        if result is None:
+            raise self._exactError(ctx, [(self.lexer.main, 0)], memo, window, tokens=(kinds, starts, ends))
+        match, index = result
+        if index != len(kinds):
+            raise self._exactError(ctx, [(self.lexer.main, 0)], memo, window, index, (kinds, starts, ends))
+        match = self.lexer.restore(match, kinds, self.buf, starts, ends)
+        return (yield from self._evaluate(match, engine, every))
+    
+    def _exactError(self, ctx, attempts, memo, window, end=None, tokens=None):
+        """_matchError() for ctx after replaying attempts without regexes, which hide failures inside them."""
+        if ctx.regular:
+            buf = self.buf if tokens is None else tokens[0]
+            ctx = ParseContext(memo, window, binary=ctx.binary, regular=False)
+            for definition, index in attempts:
+                self._matchWith(definition, buf, index, ctx, "auto")
+        return self._matchError(ctx, end, tokens)
+    
+    def _matchError(self, ctx, end=None, tokens=None):
+        """The MatchError for the furthest failure in ctx; end is where a whole match stopped short, if it did."""
+        position, expected = ctx.failure, set(ctx.expected)
+        if end is not None and end >= position:
+            if end > position:
+                position, expected = end, set()
+            expected.add(None)
+        described = set()
+        if tokens is None:
+            found = None
+            if position < len(self.buf):
+                found = self.buf[position]
+                found = found if isinstance(found, int) else ord(found)
+            for definition in expected:
+                described.update(_expectations(definition, found))
+            found = "end of input" if found is None else repr(self._slice(position, position + 1))
+        else:
+            kinds, starts, ends = tokens
+            found = ord(kinds[position]) if position < len(kinds) else None
+            for definition in expected:
+                described.update(self.lexer.describe(definition, found))
+            if found is None:
+                position, found = len(self.buf), "end of input"
+            else:
+                position, found = starts[position], repr(self._slice(starts[position], ends[position]))
+        described = sorted(described - {"end of input"}) + (["end of input"] if "end of input" in described else [])
+        return self._errorAt(position, described, found)
+    
+    def _slice(self, start, end):
+        """buf[start:end], as bytes if buf is a memoryview."""
+        part = self.buf[start:end]
+        return part.tobytes() if isinstance(part, memoryview) else part
+    
+    def _errorAt(self, position, described, found):
+        """A MatchError at position in the buffer, where one of described was expected and found was found."""
+        prefix = self._slice(0, position)
+        newline = "\n" if isinstance(prefix, str) else b"\n"
+        lines = prefix.count(newline)
+        line = self.lines + lines + 1
+        column = position - prefix.rfind(newline) if lines else self.offset + position - self.lineStart + 1
+        if described:
+            summary = "expected " + (", ".join(described[:-1]) + " or " if len(described) > 1 else "") + described[-1]
+            message = f"line {line}, column {column}: {summary}, found {found}"
+        else:
+            message = f"line {line}, column {column}: unexpected {found}"
+        return MatchError(message, self.offset + position, line, column, described)
+    
+    def _matchWith(self, definition, buf, index, ctx, engine):
+        """Match definition at index with the given engine; returns the result and the engine to evaluate it with."""
+        if engine == "auto":
+            try:
+                return definition.match(buf, index, ctx), "auto"
+            except RecursionError:
+                # Memoized results are complete, so they carry over to the retry; seeds being grown aren't
+                ctx.reach = 0
+                ctx.cut, ctx.open = True, 0
+                ctx.seeds.clear()
+                if ctx.hook is not None:
+                    ctx.hook.abandon()
+                return matchIterative(definition, buf, index, ctx), "deep"
+        if engine == "iterative":
+            return matchIterative(definition, buf, index, ctx), engine
+        return definition.match(buf, index, ctx), engine
+    
+    def _matchSteps(self, definition, buf, index, ctx, engine, every):
+        """_matchWith() as a generator of steps; with every, that's matchSteps() and the iterative engine."""
+        if every:
+            return (yield from matchSteps(definition, buf, index, ctx, every)), "iterative"
+        return self._matchWith(definition, buf, index, ctx, engine)
+    
+    def _evaluate(self, match, engine, every):
+        """Evaluate match as _matchWith() says, as a generator of steps like _matchSteps()."""
+        if every:
+            return (yield from evaluateSteps(match, every))
+        if engine == "iterative":
+            return evaluateIterative(match)
+        if engine == "recursive":
+            return match.evaluate()
+        if engine == "auto":
+            try:
+                return match.evaluate()
+            except RecursionError:
+                pass
+        return evaluateDeep(match)
+    
+    def _recordPart(self, element):
+        """The parts of the main element and the top-level repetition of element among them (see records())."""
+        main = self.mainElement
+        parts = main.definition.inners if isinstance(main.definition, ConcatenationDef) else [main.definition]
+        repeated = [part for part in parts if isinstance(part, RepetitionDef) and
+                    (part.inner is element or isinstance(part.inner, ElementDef) and part.inner.name == element)]
+        if main.growsSeed or not repeated:
+            raise ParserError(f"{element} isn't repeated at the top level of {main}")
+        return parts, repeated[0]
+    
+    def records(self, element, memo=None, window=4096, engine="auto", eager=False):
+        """Parse the fed buffer, yielding the values of a top-level repetition's items one at a time."""
+        if engine not in ("auto", "recursive", "iterative"):
+            raise ValueError("Engine must be 'auto', 'recursive' or 'iterative'")
+        if self.streaming:
+            raise ParserError("Streaming parsers can't yield records")
+        if self.lexer is not None:
+            raise ParserError("Grammars with tokens can't yield records")
+        parts, repeated = self._recordPart(element)
+        ctx = ParseContext(memo, window, binary=not isinstance(self.buf, str), hook=self.hook, eager=eager)
+        index = 0
+        tried = []  # What was matched since the last record, for _exactError()
+        for part in parts:
+            if part is not repeated:
+                tried.append((part, index))
+                result, _ = self._matchWith(part, self.buf, index, ctx, engine)
+                if result is None:
+                    raise self._exactError(ctx, tried, memo, window)
+                index = result[1]
+                continue
+            low, high = part.range
+            count = 0
+            while high == -1 or count < high:
+                tried = [(part.inner, index)]
+                result, used = self._matchWith(part.inner, self.buf, index, ctx, engine)
+                if result is None:
+                    break
+                match, index = result
+                count += 1
+                yield _finish(self._evaluate(match, used, None))
+            if count < low:
+                raise self._exactError(ctx, tried, memo, window)
+        self.memoStats = ctx.stats()
+        if index != len(self.buf):
+            raise self._exactError(ctx, tried, memo, window, index)
+    
+    async def recordsAsync(self, source, element, chunkSize=65536, every=10000):
+        """Feed a streaming parser from source and yield the values of element's records as they arrive."""
+        if not self.streaming:
+            raise ParserError("Only streaming parsers can yield records as they arrive")
+        if self.lexer is not None:
+            raise ParserError("Grammars with tokens can't yield records")
+        _, self.recordPart = self._recordPart(element)
+        try:
+            async for chunk in _chunks(source, chunkSize, issubclass(self.bufferType, str)):
+                if self._queue(chunk):
+                    await _cooperate(self._advance(False, every))
+                ready, self.ready = self.ready, []
+                for match in ready:
+                    yield await _cooperate(evaluateSteps(match, every))
+            await _cooperate(self._advance(True, every))
+            ready, self.ready = self.ready, []
+            for match in ready:
+                yield await _cooperate(evaluateSteps(match, every))
+            self.memoStats = self.streamCtx.stats()
+        finally:
+            self.recordPart = None
+    
+    @classmethod
+    def parseMany(cls, iterable, workers=None, chunksize=64, **parseArgs):
+        """Parse every input of iterable on its own, in a pool of worker processes, yielding results in order."""
+        if workers is None:
+            workers = os.cpu_count() or 1
+        main = cls.lexer.main if cls.lexer is not None else cls.mainElement
+        compiled = cls.defined and (main.compiled is not None or main.compiledBinary is not None)
+        if workers <= 1:
+            parser = cls()
+            for data in iterable:
+                yield _parseOne(parser, parseArgs, data)
+            return
+        try:
+            pickle.dumps(cls)
+            setup = (cls, None, None, compiled, parseArgs)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            setup = (None, dumpGrammar(cls), cls.handlersOrigin, compiled, parseArgs)
+        with multiprocessing.Pool(workers, _startWorker, setup) as pool:
+            yield from pool.imap(_parseInWorker, iterable, chunksize)
+
+
+_worker = None
+
+
+def _startWorker(parser, source, origin, compiled, parseArgs):
+    global _worker
+    if parser is None:
+        parser = buildGrammar(source, loadHandlers(*origin) if origin is not None else None)
+        parser.handlersOrigin = origin
+    if compiled:
+        parser.compile()
+    _worker = (parser(), parseArgs)
+
+
+def _parseInWorker(data):
+    return _parseOne(*_worker, data)
+
+
+def _parseOne(parser, parseArgs, data):
+    parser.clear()
+    try:
+        parser.feed(data)
+        return parser.parse(**parseArgs)
+    except Exception as e:
+        return e
+
+
+def loadHandlers(path, handlersClass=None):
+    """Execute the Python file at path and return it, or an instance of its class handlersClass."""
+    spec = importlib.util.spec_from_file_location("module.name", path)
+    handlers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handlers)
+    if handlersClass is not None:
+        handlers = getattr(handlers, handlersClass)()
+    return handlers
+
+
+def bindHandlers(elements, handlers):
+    """Give each ElementDef in the name-keyed elements its handle_<name> from handlers."""
+    if handlers is None:
+        return
+    for name in elements:
+        elem = elements[name]
+        if hasattr(handlers, f"handle_{name}"):
+            elem.handler = getattr(handlers, f"handle_{name}")
 
 
 class MetaParserHandlers:
-    def __init__(self):
+    """Builds a parser class from a .bbnf grammar's Match tree; MetaParser uses a new one for every parse."""
+    
+    def __init__(self, handlers=None, origin=None):
         self.elements = {}
-        self.handlers = None
-        self.metadata = {"name": None, "main": None}
+        self.handlers = handlers
+        self.origin = origin
+        self.metadata = {"name": None, "main": None, "tokens": [], "skip": []}
+        self.text = None
+        self.lineStarts = None
+    
+    def _span(self, val):
+        """The Definition.span of val's text, leaving out the blanks around it."""
+        buf, start, end = val.buf, val.start, val.end
+        if buf is None:
+            return None
+        newline, blanks = ("\n", " \t") if isinstance(buf, str) else (b"\n", b" \t")
+        if buf is not self.text:
+            self.text = buf
+            self.lineStarts = [0]
+            line = buf.find(newline)
+            while line != -1:
+                self.lineStarts.append(line + 1)
+                line = buf.find(newline, line + 1)
+        text = buf[start:end]
+        start += len(text) - len(text.lstrip(blanks))
+        end -= len(text) - len(text.rstrip(blanks))
+        line = bisect.bisect_right(self.lineStarts, start)
+        endLine = bisect.bisect_right(self.lineStarts, max(end - 1, start))
+        return line, start - self.lineStarts[line - 1] + 1, endLine, end - self.lineStarts[endLine - 1] + 1
     
     def handle_defs(self, val):
         for ctrl in val.inners[0].inners:
             if ctrl.id == 0:
                 ctrl.inner.evaluate()
         for line in val.inners[1].inners:
-            line.inners[0].inner.evaluate()
-        if self.handlers is not None:
-            for name in self.elements:
-                elem = self.elements[name]
-                if hasattr(self.handlers, f"handle_{name}"):
-                    elem.handler = getattr(self.handlers, f"handle_{name}")
+            if line.inners[0].id == 0:
+                line.inners[0].inner.evaluate()
+        bindHandlers(self.elements, self.handlers)
         if self.metadata["name"] is None:
             self.metadata["name"] = "CustomParser"
-        parser = type(self.metadata["name"], (AbstractParser,), {"mainElement": self.elements[self.metadata["main"]], "defined": True})
-        return parser
+        return type(self.metadata["name"], (AbstractParser,), {"mainElement": self.elements[self.metadata["main"]], "defined": True,
+                                                              "handlersOrigin": self.origin, "rules": self.elements,
+                                                              "tokens": tuple(self.metadata["tokens"]),
+                                                              "skip": tuple(self.metadata["skip"])})
     
     def handle_defn(self, val):
-        self.elements[val.inners[0].evaluate()].define(val.inners[2].evaluate())
+        elem = self.elements[val.inners[0].evaluate()]
+        elem.define(val.inners[3].evaluate())
+        elem.span = self._span(val)
     
     def handle_disj(self, val):
         concs = [val.inners[0].evaluate()]
@@ -385,7 +3016,9 @@ class MetaParserHandlers:
             concs.append(e.inners[1].evaluate())
         if len(concs) == 1:
             return concs[0]
-        return DisjunctionDef(concs)
+        result = DisjunctionDef(concs)
+        result.span = self._span(val)
+        return result
     
     def handle_conc(self, val):
         repts = [val.inners[0].evaluate()]
@@ -393,7 +3026,9 @@ class MetaParserHandlers:
             repts.append(e.inners[1].evaluate())
         if len(repts) == 1:
             return repts[0]
-        return ConcatenationDef(repts)
+        result = ConcatenationDef(repts)
+        result.span = self._span(val)
+        return result
     
     def handle_rept(self, val):
         res = val.inners[0].evaluate()
@@ -417,6 +3052,8 @@ class MetaParserHandlers:
             return self.elements[val.inner.evaluate()]
         if val.id == 4:
             return val.inner.inners[2].evaluate()
+        if val.id == 5:
+            return CutDef()
         return val.inner.evaluate()
     
     def handle_intg(self, val):
@@ -454,8 +3091,13 @@ class MetaParserHandlers:
             assert self.metadata["name"] is None
             self.metadata["name"] = args.evaluate()
         elif cmd == "main":
-            assert self.metadata["main"] is None
-            args.evaluate()  # Writes itself to main automatically
+            # handle_elem may have claimed main already when evaluated bottom-up
+            self.metadata["main"] = args.evaluate()
+        elif cmd in ("tokens", "skip"):
+            # Unlike the first rule, the first token named doesn't become main
+            main = self.metadata["main"]
+            self.metadata[cmd].extend(e.evaluate() for e in args.inners)
+            self.metadata["main"] = main
     
     def handle_qchar(self, val):
         if val.id == 0:
@@ -466,58 +3108,89 @@ class MetaParserHandlers:
         return bytes(str(val), "utf-8").decode("unicode_escape")
 
 
+class _MetaState(threading.local):
+    # Matches evaluated outside MetaParser.parse() get handlers of their own
+    def __init__(self):
+        self.handlers = MetaParserHandlers()
+
+
+_metaState = _MetaState()
+
+
+def _metaHandler(name):
+    """Handler for a meta-grammar element, calling name on the MetaParserHandlers of the parse running in this thread."""
+    return lambda val: getattr(_metaState.handlers, name)(val)
+
+
 class MetaParser(AbstractParser):
+    """Parser for .bbnf grammars; parse() returns an AbstractParser subclass."""
+    
+    def __init__(self, streaming=False, hook=None):
+        self.optimize()
+        super().__init__(streaming, hook)
+        self.handlers = None
+        self.origin = None
+    
     def feed(self, data, handlers=None, handlersClass=None):
         super().feed(data)
         if handlers is not None:
-            spec = importlib.util.spec_from_file_location("module.name", handlers)
-            handlers = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(handlers)
-            if handlersClass is not None:
-                handlers = getattr(handlers, handlersClass)()
-            self._handlers.handlers = handlers
-            
+            self.origin = (os.path.abspath(handlers), handlersClass)
+            self.handlers = loadHandlers(handlers, handlersClass)
+    
+    def _parse(self, *args, **kwargs):
+        # The handlers are swapped in only while a step runs, since other parses may run between steps
+        steps = super()._parse(*args, **kwargs)
+        handlers = MetaParserHandlers(self.handlers, self.origin)
+        while True:
+            outer, _metaState.handlers = _metaState.handlers, handlers
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                _metaState.handlers = outer
+            yield
     
     @classmethod
     def define(cls):
-        handlers = MetaParserHandlers()
-        cls._handlers = handlers
-        
-        defs = ElementDef("defs", handlers.handle_defs)
-        defn = ElementDef("defn", handlers.handle_defn)
-        disj = ElementDef("disj", handlers.handle_disj)
-        conc = ElementDef("conc", handlers.handle_conc)
-        rept = ElementDef("rept", handlers.handle_rept)
-        range = ElementDef("range", handlers.handle_range)
-        simple = ElementDef("simple", handlers.handle_simple)
-        intg = ElementDef("intg", handlers.handle_intg)
-        strg = ElementDef("strg", handlers.handle_strg)
-        char = ElementDef("char", handlers.handle_char)
-        chrs = ElementDef("chrs", handlers.handle_chrs)
-        chrr = ElementDef("chrr", handlers.handle_chrr)
-        elem = ElementDef("elem", handlers.handle_elem)
-        cmnt = ElementDef("cmnt")
-        ctrl = ElementDef("ctrl", handlers.handle_ctrl)
-        mdata = ElementDef("mdata", handlers.handle_mdata)
-        dqchr = ElementDef("dqchar", handlers.handle_qchar)
-        sqchr = ElementDef("sqchar", handlers.handle_qchar)
-        eseq = ElementDef("eseq", handlers.handle_eseq)
-        blank = ElementDef("blank")
-        space = ElementDef("space")
+        defs = ElementDef("defs", _metaHandler("handle_defs"))
+        defn = ElementDef("defn", _metaHandler("handle_defn"))
+        disj = ElementDef("disj", _metaHandler("handle_disj"))
+        conc = ElementDef("conc", _metaHandler("handle_conc"))
+        rept = ElementDef("rept", _metaHandler("handle_rept"))
+        range = ElementDef("range", _metaHandler("handle_range"))
+        simple = ElementDef("simple", _metaHandler("handle_simple"))
+        intg = ElementDef("intg", _metaHandler("handle_intg"))
+        strg = ElementDef("strg", _metaHandler("handle_strg"))
+        char = ElementDef("char", _metaHandler("handle_char"))
+        chrs = ElementDef("chrs", _metaHandler("handle_chrs"))
+        chrr = ElementDef("chrr", _metaHandler("handle_chrr"))
+        elem = ElementDef("elem", _metaHandler("handle_elem"))
+        cmnt = ElementDef("cmnt", inline=True)
+        ctrl = ElementDef("ctrl", _metaHandler("handle_ctrl"))
+        mdata = ElementDef("mdata", _metaHandler("handle_mdata"))
+        dqchr = ElementDef("dqchar", _metaHandler("handle_qchar"))
+        sqchr = ElementDef("sqchar", _metaHandler("handle_qchar"))
+        eseq = ElementDef("eseq", _metaHandler("handle_eseq"))
+        blank = ElementDef("blank", inline=True)
+        space = ElementDef("space", inline=True)
         
         blank.define(CharSetDef(" \t") * (0, -1))
         space.define(CharSetDef(" \t") * (1, -1))
         defs.define((ctrl | cmnt) * (0, -1) + ((defn | blank) + (cmnt | "\n")) * (0, -1))
-        defn.define(ConcatenationDef([elem, StringDef("::="), disj]))
+        defn.define(ConcatenationDef([elem, StringDef("::="), CutDef(), disj]))
         disj.define(conc + ("|" + conc) * (0, -1))
         conc.define(rept + ("+" + rept) * (0, -1))
         rept.define(simple + ("*" + (intg | range)) * (0, 1))
         range.define(ConcatenationDef([blank, StringDef("("), intg, StringDef(","), (intg | ConcatenationDef([blank, StringDef("inf"), blank])), StringDef(")"), blank]))
-        simple.define(DisjunctionDef([strg, chrs, chrr, elem, ConcatenationDef([blank, StringDef("("), disj, StringDef(")"), blank])]))
+        simple.define(DisjunctionDef([strg, chrs, chrr, elem, ConcatenationDef([blank, StringDef("("), disj, StringDef(")"), blank]),
+                                      ConcatenationDef([blank, StringDef("~"), blank])]))
         cmnt.define(ConcatenationDef([blank, StringDef("#"), (~CharSetDef("\n")) * (0, -1), StringDef("\n")]))
         ctrl.define(ConcatenationDef([blank, StringDef("#:"), mdata, StringDef("\n")]))
         _ctrlComments = (("name", strg), 
-                                         ("main", elem)
+                                         ("main", elem),
+                                         ("tokens", elem * (1, -1)),
+                                         ("skip", elem * (1, -1))
                                          # Todo: use; ...
                                          )
         mdata.define(DisjunctionDef([ConcatenationDef([StringDef(name), space, args]) for name, args in _ctrlComments]))
@@ -534,16 +3207,189 @@ class MetaParser(AbstractParser):
         return defs
 
 
-targetFile = "./test/math.bbnf"
-targetHandlers = "./test/math.py"
-targetClass = None
+def dumpGrammar(parser):
+    """Python source that rebuilds the Definitions of parser's grammar; see buildGrammar()."""
+    parser.prepare()
+    lexer = parser.lexer
+    roots = [parser.mainElement] + (lexer.tokens + lexer.skip if lexer is not None else [])
+    elements = {}
+    for root in roots:
+        elements.update((d, None) for d in walk(root) if isinstance(d, ElementDef))
+    lines = [f"name = {parser.__name__!r}",
+             f"main = {parser.mainElement.name!r}",
+             f"elements = {[elem.name for elem in elements]!r}",
+             f"tokens = {[elem.name for elem in lexer.tokens] if lexer is not None else []!r}",
+             f"skip = {[elem.name for elem in lexer.skip] if lexer is not None else []!r}",
+             f"spans = {({elem.name: elem.span for elem in elements if elem.span is not None})!r}",
+             "",
+             "def define(E):"]
+    for elem in elements:
+        if elem.isDefined():
+            lines.append(f"    E[{elem.name!r}].define({_dumpDefinition(elem.definition)})")
+    lines.append("    pass")
+    return "\n".join(lines) + "\n"
+
+
+def _dumpDefinition(definition):
+    if isinstance(definition, ElementDef):
+        return f"E[{definition.name!r}]"
+    if isinstance(definition, StringDef):
+        return f"StringDef({definition.value!r})"
+    if isinstance(definition, CharRangeDef):
+        return f"CharRangeDef({definition.left!r}, {definition.right!r}, {definition.inverted})"
+    if isinstance(definition, CharSetDef):
+        return f"CharSetDef({''.join(sorted(definition.value))!r}, {definition.inverted})"
+    if isinstance(definition, (ConcatenationDef, DisjunctionDef)):
+        return f"{type(definition).__name__}([{', '.join(map(_dumpDefinition, definition.inners))}])"
+    if isinstance(definition, RepetitionDef):
+        return f"RepetitionDef({_dumpDefinition(definition.inner)}, {tuple(definition.range)!r})"
+    if isinstance(definition, CutDef):
+        return "CutDef()"
+    raise ParserError(f"Can't dump a {type(definition).__name__}")
+
+
+def buildGrammar(source, handlers=None, filename="<metaparser:grammar>"):
+    """Make a parser class from dumpGrammar() source, binding handlers to it."""
+    namespace = {"StringDef": StringDef, "CharRangeDef": CharRangeDef, "CharSetDef": CharSetDef,
+                 "ConcatenationDef": ConcatenationDef, "DisjunctionDef": DisjunctionDef,
+                 "RepetitionDef": RepetitionDef, "CutDef": CutDef}
+    exec(compile(source, filename, "exec"), namespace)
+    elements = {name: ElementDef(name) for name in namespace["elements"]}
+    namespace["define"](elements)
+    for name, span in namespace.get("spans", {}).items():
+        elements[name].span = span
+    bindHandlers(elements, handlers)
+    return type(namespace["name"], (AbstractParser,), {"mainElement": elements[namespace["main"]], "defined": True,
+                                                       "rules": elements, "tokens": tuple(namespace.get("tokens", ())),
+                                                       "skip": tuple(namespace.get("skip", ()))})
+
+
+class GrammarCache:
+    """On-disk cache of the grammars built from .bbnf files, keyed by content."""
+    
+    version = 2
+    
+    def __init__(self, directory=None, maxEntries=64):
+        if directory is None:
+            directory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "metaparser")
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, text, handlersText=b"", handlersClass=None):
+        digest = hashlib.sha256()
+        for part in (str(self.version).encode(), text.encode("utf-8"), handlersText, str(handlersClass).encode()):
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+    
+    def load(self, path, handlers=None, handlersClass=None):
+        """Same as loadGrammar(path, handlers, handlersClass), through the cache."""
+        with open(path, "r") as file:
+            text = file.read()
+        handlersText = b""
+        if handlers is not None:
+            with open(handlers, "rb") as file:
+                handlersText = file.read()
+        entry = os.path.join(self.directory, self.key(text, handlersText, handlersClass) + ".py")
+        origin = (os.path.abspath(handlers), handlersClass) if handlers is not None else None
+        handlers = loadHandlers(*origin) if origin is not None else None
+        try:
+            with open(entry, "r") as file:
+                source = file.read()
+            parser = buildGrammar(source, handlers, entry)
+        except Exception:  # Missing, or unusable however it got that way
+            self.misses += 1
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            mp = MetaParser()
+            mp.feed(text)
+            source = dumpGrammar(mp.parse())
+            self._store(entry, source)
+            parser = buildGrammar(source, handlers, entry)
+        else:
+            self.hits += 1
+            os.utime(entry)
+        parser.handlersOrigin = origin
+        return parser
+    
+    def clear(self):
+        for entry in self._entries():
+            os.remove(entry)
+    
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".py")]
+    
+    def _store(self, entry, source):
+        os.makedirs(self.directory, exist_ok=True)
+        temp = f"{entry}.{os.getpid()}.tmp"
+        with open(temp, "w") as file:
+            file.write(source)
+        os.replace(temp, entry)
+        entries = sorted(self._entries(), key=lambda e: os.stat(e).st_mtime)
+        for old in entries[:max(len(entries) - self.maxEntries, 0)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass  # Another process got to it first
+
+
+def loadGrammar(path, handlers=None, handlersClass=None, cache=None):
+    """Build a parser class from the .bbnf grammar at path, with the handler functions in the file handlers."""
+    if cache is not None:
+        return cache.load(path, handlers, handlersClass)
+    mp = MetaParser()
+    with open(path, "r") as file:
+        mp.feed(file.read(), handlers=handlers, handlersClass=handlersClass)
+    return mp.parse()
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description="Parse input with a .bbnf grammar and print the result.")
+    argParser.add_argument("grammar", help="the .bbnf grammar file")
+    argParser.add_argument("input", nargs="*", help="texts to parse; standard input is read if there are none")
+    argParser.add_argument("--handlers", help="Python file with the grammar's handlers")
+    argParser.add_argument("--handlers-class", help="class in the handlers file to take the handlers from")
+    argParser.add_argument("--optimize", action="store_true", help="optimize the grammar first, reporting the changes on stderr")
+    argParser.add_argument("--compile", action="store_true", help="compile the grammar to Python code first")
+    argParser.add_argument("--cache", metavar="DIR", help="cache built grammars in DIR")
+    argParser.add_argument("--profile", action="store_true", help="report the parse work per grammar line on stderr")
+    argParser.add_argument("--profile-stacks", metavar="FILE", help="write the profile to FILE as collapsed stacks, for flame graphs")
+    args = argParser.parse_intermixed_args(argv)
+    
+    cache = GrammarCache(args.cache) if args.cache is not None else None
+    Parser = loadGrammar(args.grammar, args.handlers, args.handlers_class, cache)
+    if args.optimize:
+        print(Parser.optimize().report(), file=sys.stderr)
+    if args.compile:
+        Parser.compile()
+    profiler = GrammarProfiler() if args.profile or args.profile_stacks else None
+    try:
+        for text in args.input or [sys.stdin.read().rstrip("\n")]:
+            p = Parser()
+            p.feed(text)
+            try:
+                print(p.parse(profile=profiler))
+            except ParserError as e:
+                print(f"{type(e).__name__}: {e}", file=sys.stderr)
+                return 1
+    finally:
+        if args.profile:
+            profiler.report(sys.stderr)
+        if args.profile_stacks:
+            with open(args.profile_stacks, "w") as file:
+                profiler.collapsed(file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
-mp = MetaParser()
-mp.feed(open(targetFile, "r").read(), handlers=targetHandlers, handlersClass=targetClass)
-Parser = mp.parse()
-p = Parser()
-p.feed("1+2*(3-14)--17")
-print(p.parse())
 
 
 
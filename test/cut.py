@@ -0,0 +1,12 @@
+def handle_list(val):
+    return [e.inners[0].evaluate() for e in val.inners]
+
+def handle_item(val):
+    if val.id == 0:
+        return val.inner.inners[2].evaluate()
+    if val.id == 1:
+        return "x"
+    return val.inner.evaluate()
+
+def handle_num(val):
+    return int(str(val))
@@ -0,0 +1,23 @@
+def handle_expr(val):
+    if val.id == 1:
+        return val.inner.evaluate()
+    left, op, right = val.inner.inners
+    if str(op) == "+":
+        return left.evaluate() + right.evaluate()
+    return left.evaluate() - right.evaluate()
+
+def handle_term(val):
+    if val.id == 1:
+        return val.inner.evaluate()
+    left, op, right = val.inner.inners
+    if str(op) == "*":
+        return left.evaluate() * right.evaluate()
+    return left.evaluate() // right.evaluate()
+
+def handle_factor(val):
+    if val.id == 0:
+        return val.inner.evaluate()
+    return val.inner.inners[1].evaluate()
+
+def handle_number(val):
+    return int(str(val))
@@ -0,0 +1,845 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import metaparser
+
+
+HERE = os.path.dirname(__file__)
+
+
+def load(name):
+    """A fresh parser class for test/<name>.bbnf; compile() and optimize() change the class they're called on."""
+    handlers = os.path.join(HERE, name + ".py")
+    return metaparser.loadGrammar(os.path.join(HERE, name + ".bbnf"), handlers if os.path.exists(handlers) else None)
+
+
+def outcome(parse):
+    try:
+        return "ok", parse()
+    except metaparser.MatchError:
+        return "error", None
+
+
+def plain(cls, text):
+    parser = cls()
+    parser.feed(text)
+    return outcome(lambda: parser.parse(engine="recursive"))
+
+
+def withArgs(**parseArgs):
+    def run(name, text):
+        parser = load(name)()
+        parser.feed(text)
+        return outcome(lambda: parser.parse(**parseArgs))
+    return run
+
+
+def compiled(name, text):
+    cls = load(name)
+    cls.compile()
+    return plain(cls, text)
+
+
+def optimized(name, text):
+    cls = load(name)
+    cls.optimize()
+    return plain(cls, text)
+
+
+def optimizedCompiled(name, text):
+    cls = load(name)
+    cls.optimize()
+    cls.compile()
+    return plain(cls, text)
+
+
+def binary(name, text):
+    cls = load(name)
+    return plain(type(cls.__name__, (cls,), {"bufferType": bytes}), text.encode())
+
+
+def streaming(name, text):
+    parser = load(name)(streaming=True)
+    
+    def run():
+        for i in range(0, len(text), 3):
+            parser.feed(text[i:i + 3])
+        return parser.parse()
+    return outcome(run)
+
+
+def incremental(name, text):
+    """Parse a corrupted copy of text, then edit it back and reparse incrementally."""
+    rng = random.Random(text)
+    parser = load(name)()
+    cut = rng.randrange(len(text) + 1)
+    end = min(len(text), cut + rng.randrange(4))
+    parser.feed(text[:cut] + "7" + text[end:])
+    outcome(lambda: parser.parse(incremental=True))
+    parser.edit(cut, cut + 1, text[cut:end])
+    return outcome(lambda: parser.parse(incremental=True))
+
+
+VARIANTS = {
+    "bounded": withArgs(memo="bounded", window=8),
+    "full": withArgs(memo="full"),
+    "iterative": withArgs(engine="iterative"),
+    "iterativeFull": withArgs(engine="iterative", memo="full"),
+    "auto": withArgs(),
+    "eager": withArgs(eager=True),
+    "compiled": compiled,
+    "optimized": optimized,
+    "optimizedCompiled": optimizedCompiled,
+    "bytes": binary,
+    "streaming": streaming,
+    "incremental": incremental,
+}
+
+
+def arithmetic(rng, depth, unary):
+    if depth <= 0 or rng.random() < 0.3:
+        term = str(rng.randrange(100))
+        return "-" + term if unary and rng.random() < 0.2 else term
+    if rng.random() < 0.3:
+        return "(" + arithmetic(rng, depth - 1, unary) + ")"
+    return arithmetic(rng, depth - 1, unary) + rng.choice("+-*") + arithmetic(rng, depth - 1, unary)
+
+
+def items(rng, depth):
+    return "".join(rng.choice(["(%d);" % rng.randrange(50), "(x;", "%d;" % rng.randrange(50)])
+                   for _ in range(rng.randrange(6)))
+
+
+GENERATORS = {
+    "math": lambda rng: arithmetic(rng, 4, True),
+    "lr": lambda rng: arithmetic(rng, 4, False),
+    "cut": lambda rng: items(rng, 0),
+}
+
+
+def mutate(rng, text):
+    i = rng.randrange(len(text) + 1)
+    if text and rng.random() < 0.5:
+        return text[:i] + text[i + 1:]
+    return text[:i] + rng.choice("0+-*()x;") + text[i:]
+
+
+def cases(name, count=25):
+    rng = random.Random(name)
+    texts = [GENERATORS[name](rng) for _ in range(count)]
+    return texts + [mutate(rng, text) for text in texts]
+
+
+@pytest.mark.parametrize("variant", sorted(VARIANTS))
+@pytest.mark.parametrize("name", sorted(GENERATORS))
+def test_variantsMatchPlainParse(name, variant):
+    reference = load(name)
+    for text in cases(name):
+        assert VARIANTS[variant](name, text) == plain(reference, text), text
+
+
+def test_cutRejectsBacktracking():
+    assert plain(load("cut"), "(1);2;") == ("ok", [1, 2])
+    assert plain(load("cut"), "(x;") == ("error", None)
+
+
+def test_leftRecursionAfterRecursionError():
+    parser = load("lr")()
+    parser.feed("(" * 400 + "1+2-3" + ")" * 400 + "-4-5")
+    assert parser.parse(memo="full") == -9
+
+
+def nestingParser(skipped):
+    """nest ::= "(" + nest + skip + ")" | "x", whose handler counts the levels and never evaluates skip."""
+    class Nesting(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            nest = metaparser.ElementDef("nest", lambda val: 1 + val.inner.inners[1].evaluate() if val.id == 0 else 0)
+            skip = metaparser.ElementDef("skip", lambda val: skipped.append(val))
+            skip.define(metaparser.StringDef("s"))
+            nested = metaparser.ConcatenationDef([metaparser.StringDef("("), nest, skip, metaparser.StringDef(")")])
+            nest.define(metaparser.DisjunctionDef([nested, metaparser.StringDef("x")]))
+            return nest
+    return Nesting
+
+
+def test_deepLeftRecursionEvaluates():
+    parser = load("lr")()
+    parser.feed("-".join(["1"] * 3000))
+    assert parser.parse() == -2998
+
+
+@pytest.mark.parametrize("memo", [None, "full"])
+def test_deepFallbackRunsOnlyDemandedHandlers(memo):
+    skipped = []
+    parser = nestingParser(skipped)()
+    parser.feed("(" * 3000 + "x" + "s)" * 3000)
+    assert parser.parse(memo=memo) == 3000
+    assert skipped == []
+    assert parser.parse(engine="iterative") == 3000
+    assert len(skipped) == 3000
+
+
+def errorMessage(parser, text):
+    parser.feed(text)
+    with pytest.raises(metaparser.MatchError) as error:
+        parser.parse()
+    return str(error.value)
+
+
+def test_regularElementsReportFurthestFailure():
+    assert errorMessage(load("records")(), "H\n1\n2\nx\n") == \
+        "line 4, column 1: expected '0'..'9' or 'END\\n', found 'x'"
+    message = errorMessage(metaparser.MetaParser(), "s ::= \n")
+    assert message.startswith("line 1, column 7: expected ") and "'A'..'Z'" in message
+
+
+def itemsParser():
+    """list ::= item * (0, inf), item ::= "(" + num + ")", num ::= ["0"-"9"] * (1, inf); all regular."""
+    class Items(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            items, item, num = metaparser.ElementDef("list"), metaparser.ElementDef("item"), metaparser.ElementDef("num")
+            num.define(metaparser.RepetitionDef(metaparser.CharRangeDef("0", "9"), (1, -1)))
+            item.define(metaparser.ConcatenationDef([metaparser.StringDef("("), num, metaparser.StringDef(")")]))
+            items.define(metaparser.RepetitionDef(item, (0, -1)))
+            return items
+    return Items
+
+
+@pytest.mark.parametrize("variant", ["auto", "full", "iterative", "records", "compiled"])
+def test_regularElementsReportFailuresInside(variant):
+    cls = itemsParser()
+    if variant == "compiled":
+        cls.compile()
+    parser = cls()
+    parser.feed("(1)(22x)")
+    with pytest.raises(metaparser.MatchError) as error:
+        if variant == "records":
+            list(parser.records("item"))
+        else:
+            parser.parse(**{"full": {"memo": "full"}, "iterative": {"engine": "iterative"}}.get(variant, {}))
+    assert str(error.value) == "line 1, column 7: expected ')', found 'x'"
+
+
+def test_compiledDispatchAfterSharedPrefix():
+    """Alternatives that share a prefix dispatch on the character where the disjunction started."""
+    class Shared(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            s = metaparser.ElementDef("s", lambda val: (val.id, str(val)))
+            s.define(metaparser.DisjunctionDef([metaparser.StringDef("a") + "b", metaparser.StringDef("a") + "c",
+                                                metaparser.StringDef("x") + s]))  # Recursive, so s has no regex
+            return s
+    expected = [plain(Shared, text) for text in ("ab", "ac", "xac", "ad")]
+    assert expected == [("ok", (0, "ab")), ("ok", (1, "ac")), ("ok", (2, "xac")), ("error", None)]
+    Shared.compile()
+    assert [plain(Shared, text) for text in ("ab", "ac", "xac", "ad")] == expected
+
+
+def test_optimizerKeepsShapesHandlersWalk():
+    class Walked(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            top = metaparser.ElementDef("top", lambda val: str(val.inners[0].inner.inners[1]))
+            pair = metaparser.ElementDef("pair")
+            pair.define(metaparser.StringDef("a") + "b" + "c")  # ("a" + "b") + "c"
+            top.define(metaparser.ConcatenationDef([pair, metaparser.StringDef("!")]))
+            return top
+    assert plain(Walked, "abc!") == ("ok", "c")
+    assert Walked.optimize().report() == "no changes"
+    assert plain(Walked, "abc!") == ("ok", "c")
+    
+    class Unobserved(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            root = metaparser.ElementDef("root")
+            root.define(metaparser.StringDef("a") + "b" + "c")
+            return root
+    assert "merged 'a' + 'b' in <root>" in Unobserved.optimize().report()
+    assert plain(Unobserved, "abc") == ("ok", None)
+
+
+@pytest.mark.parametrize("hook", [metaparser.GrammarProfiler, metaparser.ElementProfiler, metaparser.PrintTracer])
+def test_hooksRecoverFromFallback(hook, tmp_path):
+    with open(tmp_path / "trace.txt", "w") as file:
+        profiler = hook(file) if hook is metaparser.PrintTracer else hook()
+        parser = load("math")()
+        parser.feed("(" * 2000 + "1" + ")" * 2000)
+        assert parser.parse(profile=profiler) == 1
+    if hook is metaparser.PrintTracer:
+        assert profiler.depth == 0
+    else:
+        assert profiler.stack == []
+    if hook is metaparser.GrammarProfiler:
+        assert not any(profiler.active.values())
+        assert profiler.stats[8]["successes"] >= 2001  # factor, at least once per nesting level
+
+
+@pytest.mark.parametrize("engine", ["recursive", "iterative"])
+@pytest.mark.parametrize("name", sorted(GENERATORS))
+def test_incrementalEditsMatchFreshParse(name, engine):
+    rng = random.Random(name + engine)
+    reference = load(name)
+    parser = load(name)()
+    parser.feed(";".join(GENERATORS[name](rng) for _ in range(5)) if name == "cut" else GENERATORS[name](rng))
+    for _ in range(40):
+        start = rng.randrange(len(parser.buf) + 1)
+        end = min(len(parser.buf), start + rng.randrange(3))
+        parser.edit(start, end, "".join(rng.choice("0123+-*();x") for _ in range(rng.randrange(3))))
+        assert outcome(lambda: parser.parse(incremental=True, engine=engine)) == plain(reference, parser.buf), parser.buf
+
+
+def test_incrementalReusesRunsAndValues():
+    cls = load("math")
+    calls = []
+    for element in cls.rules.values():
+        element.handler = lambda val, handler=element.handler: calls.append(val) or handler(val)
+    parser = cls()
+    parser.feed("+".join(["(1*2)"] * 2000))
+    assert parser.parse(incremental=True) == 4000
+    middle = parser.buf.index("1", len(parser.buf) // 2)
+    for edit in [(middle, middle + 1, "3"), (0, 0, "7+")]:
+        parser.edit(*edit)
+        del calls[:]
+        value = parser.parse(incremental=True)
+        assert parser.memoStats["hits"] < 10
+        assert len(calls) < 10
+        assert value == plain(cls, parser.buf)[1]
+
+
+@pytest.mark.parametrize("engine", ["recursive", "iterative"])
+def test_incrementalRepetitionInLeftCycle(engine):
+    class Sums(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            e = metaparser.ElementDef("e", lambda val: str(val))
+            item = metaparser.DisjunctionDef([metaparser.ConcatenationDef([e, metaparser.StringDef("+")]),
+                                              metaparser.CharRangeDef("0", "9")])
+            e.define(metaparser.RepetitionDef(item, (1, -1)))
+            return e
+    parser = Sums()
+    for text in ["1", "+", "2", "+3"]:
+        parser.feed(text)
+        assert outcome(lambda: parser.parse(incremental=True, engine=engine)) == plain(Sums, parser.buf)
+    parser.edit(1, 2, "")
+    assert outcome(lambda: parser.parse(incremental=True, engine=engine)) == plain(Sums, parser.buf)
+
+
+def test_streamingKeepsFewBuffers():
+    text = "H\n" + "".join("%d\n" % (i * 7919 % 100000) for i in range(5000)) + "END\n"
+    parser = load("records")(streaming=True)
+    for i in range(0, len(text), 64):
+        parser.feed(text[i:i + 64])
+    stack, buffers = [parser._resume(True)], {}
+    while stack:
+        match = stack.pop()
+        if isinstance(match, (metaparser.ElementMatch, metaparser.DisjunctionMatch)):
+            stack.append(match.inner)
+        elif isinstance(match, metaparser.ConcatenationMatch) and not isinstance(match, metaparser.RunMatch):
+            stack.extend(match.inners)
+        else:
+            buffers[id(match.buf)] = len(match.buf)
+    assert len(buffers) < 20
+    assert sum(buffers.values()) <= 3 * len(text)
+
+
+def test_noRegexesWithoutAtomicGroups(monkeypatch):
+    monkeypatch.setattr(metaparser, "_atomicRegexes", False)
+    cls = load("records")
+    cls.prepare()
+    assert cls.analysis.regexes == {}
+    assert errorMessage(cls(), "H\n1\nx\n") == "line 3, column 1: expected '0'..'9' or 'END\\n', found 'x'"
+    tokenized = type("Tokenized", (cls,), {"tokens": ("line",), "analysis": None})
+    with pytest.raises(metaparser.ParserError):
+        tokenized.prepare()
+
+
+def optionalParser():
+    """s ::= "x" + opt, opt ::= "y" | "", where the empty literal, like any other, needs a character to follow."""
+    class Optional(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            s = metaparser.ElementDef("s", lambda val: val.inners[1].evaluate())
+            opt = metaparser.ElementDef("opt", lambda val: (val.id, str(val)))
+            opt.define(metaparser.DisjunctionDef([metaparser.StringDef("y"), metaparser.StringDef("")]))
+            s.define(metaparser.ConcatenationDef([metaparser.StringDef("x"), opt]))
+            return s
+    return Optional
+
+
+@pytest.mark.parametrize("bufferType", [str, bytes])
+def test_emptyLiteralRegexAgreesWithInterpreter(bufferType, monkeypatch):
+    texts = ["x", "xy", "xz", "y"]
+    if bufferType is bytes:
+        texts = [text.encode() for text in texts]
+    cls = type("Optional", (optionalParser(),), {"bufferType": bufferType})
+    cls.prepare()
+    assert "opt" in [element.name for element in cls.analysis.regexes]
+    regular = [plain(cls, text) for text in texts]
+    monkeypatch.setattr(metaparser, "_atomicRegexes", False)
+    cls = type("Optional", (optionalParser(),), {"bufferType": bufferType})
+    cls.prepare()
+    assert cls.analysis.regexes == {}
+    assert regular == [plain(cls, text) for text in texts]
+
+
+def test_grammarCache(tmp_path):
+    for name in ("math.bbnf", "math.py", "lr.bbnf", "lr.py"):
+        with open(os.path.join(HERE, name)) as source, open(tmp_path / name, "w") as copy:
+            copy.write(source.read())
+    cache = metaparser.GrammarCache(str(tmp_path / "cache"), maxEntries=2)
+    
+    def parse(name, text):
+        return plain(cache.load(str(tmp_path / (name + ".bbnf")), str(tmp_path / (name + ".py"))), text)
+    
+    def entry(name):
+        text = (tmp_path / (name + ".bbnf")).read_text()
+        return os.path.join(cache.directory, cache.key(text, (tmp_path / (name + ".py")).read_bytes()) + ".py")
+    assert parse("math", "1+2*3") == ("ok", 7)
+    assert parse("math", "1+2*3") == ("ok", 7)
+    assert (cache.hits, cache.misses) == (1, 1)
+    with open(tmp_path / "math.py", "a") as file:
+        file.write("\n\ndef handle_number(val):\n    return 10\n")
+    assert parse("math", "1+2") == ("ok", 20)
+    stale = entry("math")
+    with open(tmp_path / "math.bbnf", "a") as file:
+        file.write("\n")
+    assert parse("math", "1+2") == ("ok", 20)
+    assert (cache.hits, cache.misses) == (1, 3)
+    with open(entry("math"), "w") as file:
+        file.write("raise RuntimeError('corrupt')\n")
+    assert parse("math", "1+2") == ("ok", 20)
+    assert parse("math", "1+2") == ("ok", 20)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert sorted(cache._entries()) == sorted([stale, entry("math")])
+    os.utime(stale, (1, 1))
+    assert parse("lr", "1-2-3") == ("ok", -4)
+    assert sorted(cache._entries()) == sorted([entry("math"), entry("lr")])
+
+
+@pytest.mark.parametrize("kind", ["bytes", "memoryview", "mmap"])
+@pytest.mark.parametrize("text", ["1+2*(3-4)", "1+2*(3-x)"])
+def test_binaryBuffers(kind, text, tmp_path):
+    cls = load("math")
+    cls = type(cls.__name__, (cls,), {"bufferType": bytes})
+    expected = plain(cls, text.encode())
+    (tmp_path / "input").write_bytes(text.encode())
+    for compile in (False, True):
+        if compile:
+            cls.compile()
+        parser = cls()
+        if kind == "mmap":
+            with parser.mapFile(tmp_path / "input") as mapping:
+                assert outcome(parser.parse) == expected
+            assert mapping.closed
+            mapping = parser.mapFile(tmp_path / "input")
+            parser.clear()
+            assert mapping.closed
+            continue
+        parser.buf = memoryview(b"  " + text.encode())[2:] if kind == "memoryview" else text.encode()
+        assert outcome(parser.parse) == expected
+        if expected[0] == "error":
+            with pytest.raises(metaparser.MatchError, match=r"^line 1, column 8: .*, found b'x'$"):
+                parser.parse()
+
+
+class Digits(metaparser.AbstractParser):
+    """digits ::= ["0"-"9"] * (1, inf), valued as an int; at module level, so workers get it by reference."""
+    
+    @classmethod
+    def define(cls):
+        digits = metaparser.ElementDef("digits", lambda val: int(str(val)))
+        digits.define(metaparser.RepetitionDef(metaparser.CharRangeDef("0", "9"), (1, -1)))
+        return digits
+
+
+def results(values):
+    """values with errors replaced by what they say, since exceptions don't compare equal."""
+    return [(type(value).__name__, str(value), value.line, value.column) if isinstance(value, Exception) else value
+            for value in values]
+
+
+@pytest.mark.parametrize("kind", ["bbnf", "compiled", "class"])
+def test_parseManyWorkersAgree(kind):
+    cls = Digits if kind == "class" else load("math")
+    texts = ["12", "007", "1x", ""] if kind == "class" else ["1+2", "2*(3-1)", "1+", "(7", "-4*2"]
+    if kind == "compiled":
+        cls.compile()
+    expected = [plain(cls, text) for text in texts]
+    single = results(cls.parseMany(texts * 3, workers=1))
+    assert single == results(cls.parseMany(texts * 3, workers=2, chunksize=2))
+    assert [("ok", value) if not isinstance(value, tuple) else ("error", None) for value in single] == expected * 3
+    errors = [value for value in single if isinstance(value, tuple)]
+    assert errors and all(error[0] == "MatchError" for error in errors)
+
+
+def tokenized(tmp_path):
+    """math.bbnf with number as a token and blanks and comments skipped."""
+    with open(os.path.join(HERE, "math.bbnf")) as file:
+        source = file.read().replace("#:main expr\n", "#:main expr\n#:tokens number\n#:skip blank comment\n")
+    source += 'blank ::= {" \\t\\n"} * (1, inf)\ncomment ::= "#" + ["a"-"z"] * (0, inf) + "\\n"\n'
+    (tmp_path / "tokens.bbnf").write_text(source)
+    return metaparser.loadGrammar(str(tmp_path / "tokens.bbnf"), os.path.join(HERE, "math.py"))
+
+
+@pytest.mark.parametrize("variant", ["plain", "full", "iterative", "compiled", "bytes"])
+def test_tokensAndSkip(variant, tmp_path):
+    cls = tokenized(tmp_path)
+    if variant == "compiled":
+        cls.compile()
+    elif variant == "bytes":
+        cls = type(cls.__name__, (cls,), {"bufferType": bytes})
+    args = {"full": {"memo": "full"}, "iterative": {"engine": "iterative"}}.get(variant, {})
+    reference = load("math")
+    for text in cases("math"):
+        spaced = "".join(char if char.isdigit() else f" {char} " for char in text).replace("(", "( #open\n")
+        parser = cls()
+        parser.feed(spaced.encode() if variant == "bytes" else spaced)
+        assert outcome(lambda: parser.parse(**args)) == plain(reference, text), spaced
+    parser = cls()
+    parser.feed(b"12 +\t3" if variant == "bytes" else "12 +\t3")
+    assert parser.parse(**args) == 15
+
+
+@pytest.mark.parametrize("text, message", [
+    ("1 + + 2", "line 1, column 5: expected '(', '-' or <number>, found '+'"),
+    ("1 +\n2 #no!\n", "line 2, column 6: expected '\\n', found '!'"),
+    ("1 + 2 #open", "line 1, column 12: expected '\\n', found end of input"),
+    ("1 + 2 ?", "line 1, column 7: unexpected '?'"),
+])
+def test_tokenErrors(text, message, tmp_path):
+    assert errorMessage(tokenized(tmp_path)(), text) == message
+
+
+def recordsParser(**kwargs):
+    """records.bbnf with each line valued as its number."""
+    cls = load("records")
+    cls.prepare()
+    cls.rules["line"].handler = lambda val: int(str(val))
+    return cls(**kwargs)
+
+
+def readerOf(text, size=7):
+    """An asyncio.StreamReader that is given text, as UTF-8, size bytes at a time by a task of its own."""
+    import asyncio
+    reader = asyncio.StreamReader()
+    
+    async def write():
+        data = text.encode()
+        for i in range(0, len(data), size):
+            reader.feed_data(data[i:i + size])
+            await asyncio.sleep(0)
+        reader.feed_eof()
+    reader.writer = asyncio.ensure_future(write())
+    return reader
+
+
+def test_parseAsync():
+    import asyncio
+    text = "+".join(["(1*2)-3"] * 200)
+    expected = plain(load("math"), text)[1]
+    
+    async def run():
+        ticks = []
+        ticker = asyncio.ensure_future(tickEvery(ticks))
+        parser = load("math")()
+        parser.feed(text)
+        values = [await parser.parseAsync(every=50), await load("math").parseTextAsync(text, every=None),
+                  await load("math").parseTextAsync(text, offload=True)]
+        ticker.cancel()
+        parser = load("math")(streaming=True)
+        await parser.feedAsync(readerOf(text), chunkSize=5, every=50)
+        values.append(await parser.parseAsync(every=50))
+        return values, len(ticks)
+    
+    async def tickEvery(ticks):
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0)
+    values, ticks = asyncio.run(run())
+    assert values == [expected] * 4
+    assert ticks > 10  # Other tasks ran while the parse was going on
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_feedAsyncError(streaming):
+    import asyncio
+    text = "H\n" + "".join("%d\n" % i for i in range(50)) + "x\n" + "".join("%d\n" % i for i in range(50)) + "END\n"
+    
+    async def run():
+        parser = recordsParser(streaming=streaming)
+        await parser.feedAsync(readerOf(text), chunkSize=5)
+        return parser.parse()
+    with pytest.raises(metaparser.MatchError, match=r"^line 52, column 1: "):
+        asyncio.run(run())
+
+
+def test_recordsAsync():
+    import asyncio
+    lines = ["%d\n" % (i * 37 % 1000) for i in range(300)]
+    
+    async def run(text):
+        values = []
+        parser = recordsParser(streaming=True)
+        try:
+            async for value in parser.recordsAsync(readerOf(text), "line", chunkSize=5, every=20):
+                values.append(value)
+        except metaparser.MatchError as error:
+            return values, str(error)
+        return values, None
+    assert asyncio.run(run("H\n" + "".join(lines) + "END\n")) == ([int(line) for line in lines], None)
+    values, error = asyncio.run(run("H\n" + "".join(lines[:100]) + "1x\n" + "".join(lines[100:]) + "END\n"))
+    assert values == [int(line) for line in lines[:100]]
+    assert error.startswith("line 102, column 2: ")
+
+
+def peakMemory(run):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("args", [{}, {"memo": "bounded", "window": 16}, {"memo": "full"},
+                                  {"engine": "iterative"}, {"eager": True}])
+def test_recordsAcrossFeeds(args):
+    numbers = [i * 7919 % 100000 for i in range(500)]
+    text = "H\n" + "".join("%d\n" % number for number in numbers) + "END\n"
+    parser = recordsParser()
+    for i in range(0, len(text), 4):  # Most records straddle two feeds
+        parser.feed(text[i:i + 4])
+    assert list(parser.records("line", **args)) == numbers
+    parser = recordsParser()
+    parser.feed(text[:-2])
+    with pytest.raises(metaparser.MatchError):
+        list(parser.records("line", **args))
+
+
+def test_recordsAndEagerBoundMemory():
+    def records(count):
+        parser = recordsParser()
+        parser.feed("H\n" + "".join("%d\n" % i for i in range(count)) + "END\n")
+        return peakMemory(lambda: sum(parser.records("line", memo="bounded", window=64)))
+    assert records(10000) < 2 * records(1000)  # Items are dropped as they're evaluated
+    
+    def parse(**args):
+        parser = load("math")()
+        parser.feed("+".join(["(1*2)-3"] * 1000))
+        return peakMemory(lambda: parser.parse(**args))
+    assert parse(eager=True) < parse() / 2  # Reduced matches release their trees
+
+
+def test_grammarProfiler(tmp_path, capsys):
+    parser = load("math")()
+    parser.feed("1+2*(3-4)")
+    profiler = metaparser.GrammarProfiler()
+    assert parser.parse(profile=profiler) == -1
+    counts = {line: (stats["elements"], stats["calls"], stats["successes"], stats["fails"], stats["consumed"])
+              for line, stats in profiler.stats.items()}
+    assert counts == {5: (["expr"], 2, 2, 0, 12), 6: (["term"], 4, 4, 0, 10),
+                      8: (["factor"], 5, 5, 0, 9), 9: (["number"], 4, 4, 0, 4)}
+    profiler.report()
+    header, *rows = capsys.readouterr().out.splitlines()
+    assert header.split() == ["line", "elements", "calls", "successes", "fails", "consumed", "rescanned", "time", "own"]
+    assert sorted(row.split()[:7] for row in rows) == sorted(
+        [str(line), *elements, str(calls), str(successes), str(fails), str(consumed), "0"]
+        for line, (elements, calls, successes, fails, consumed) in counts.items())
+    profiler.collapsed()
+    stacks = [line.rsplit(" ", 1) for line in capsys.readouterr().out.splitlines()]
+    assert stacks and all(int(micros) > 0 for stack, micros in stacks)
+    nesting = {"expr:5": "term:6", "term:6": "factor:8", "factor:8": "expr:5 number:9"}
+    for stack, micros in stacks:
+        frames = stack.split(";")
+        assert frames[0] == "expr:5"
+        assert all(inner in nesting[outer].split() for outer, inner in zip(frames, frames[1:])), stack
+    
+    metaparser.main([os.path.join(HERE, "math.bbnf"), "--handlers", os.path.join(HERE, "math.py"), "--profile",
+                     "--profile-stacks", str(tmp_path / "stacks.txt"), "1+2*(3-4)"])
+    out, err = capsys.readouterr()
+    assert out == "-1\n" and err.split()[:9] == header.split()
+    assert all(line.startswith("expr:5") for line in (tmp_path / "stacks.txt").read_text().splitlines())
+
+
+def test_grammarProfilerCountsRescans():
+    class Rescanning(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            s, a = metaparser.ElementDef("s"), metaparser.ElementDef("a")
+            a.define(metaparser.StringDef("aaa"))
+            s.define(metaparser.DisjunctionDef([metaparser.ConcatenationDef([a, metaparser.StringDef("x")]),
+                                                metaparser.ConcatenationDef([a, metaparser.StringDef("y")])]))
+            return s
+    parser = Rescanning()
+    parser.feed("aaay")
+    profiler = metaparser.GrammarProfiler()
+    parser.parse(profile=profiler)
+    assert profiler.stats["s"]["rescanned"] == 3
+    assert (profiler.stats["a"]["calls"], profiler.stats["a"]["consumed"]) == (2, 6)
+
+
+def test_failuresReturnNone(monkeypatch):
+    digit = metaparser.CharRangeDef("0", "9")
+    definitions = [metaparser.StringDef("ab"), digit, metaparser.CharSetDef("+-"),
+                   metaparser.ConcatenationDef([digit, metaparser.StringDef("b")]),
+                   metaparser.DisjunctionDef([metaparser.StringDef("x"), digit]),
+                   metaparser.RepetitionDef(digit, (2, -1))]
+    root = metaparser.ElementDef("root")
+    root.define(metaparser.DisjunctionDef(definitions))
+    metaparser.GrammarAnalysis(root).install()
+    
+    def noErrors(*args, **kwargs):
+        raise AssertionError("MatchError raised while matching")
+    monkeypatch.setattr(metaparser.MatchError, "__init__", noErrors)
+    for definition in definitions:
+        assert definition.match("a1.", 0, metaparser.ParseContext()) is None, definition
+        assert definition.check("a1.", 0) is False, definition
+    assert definitions[-1].check("12", 0) is True
+    assert root.match("?", 0, metaparser.ParseContext()) is None
+
+
+def test_compactMatches():
+    class Words(metaparser.AbstractParser):
+        @classmethod
+        def define(cls):
+            words, word = metaparser.ElementDef("words", lambda val: val), metaparser.ElementDef("word", str)
+            word.define(metaparser.RepetitionDef(metaparser.DisjunctionDef(
+                [metaparser.CharRangeDef("a", "z")] + [metaparser.StringDef(char) for char in "àéü"]), (1, -1)))
+            words.define(metaparser.ConcatenationDef(
+                [word, metaparser.RepetitionDef(metaparser.ConcatenationDef([metaparser.StringDef(" "), word]), (0, -1))]))
+            return words
+    for buf in ["déjà vu über", "déjà vu über".encode()]:
+        parser = type("Words", (Words,), {"bufferType": type(buf)})()
+        parser.feed(buf)
+        root = parser.parse(engine="recursive")
+        stack = [root]
+        while stack:
+            match = stack.pop()
+            assert not hasattr(match, "__dict__"), type(match)
+            assert match.buf is parser.buf
+            if hasattr(match, "inners"):
+                stack.extend(match.inners)
+            elif hasattr(match, "inner"):
+                stack.append(match.inner)
+        first, rest = root.inners
+        assert (first.definition.name, str(first), first.evaluate()) == ("word", "déjà", "déjà")
+        assert [str(item.inners[1]) for item in rest.inners] == ["vu", "über"]
+        assert str(root) == "déjà vu über"
+        assert rest.value == buf[first.end:] and rest.start == first.end == (4 if isinstance(buf, str) else 6)
+
+
+class Recorder(metaparser.TraceHook):
+    def __init__(self):
+        self.events = []
+    
+    def enter(self, definition, index):
+        self.events.append(("enter", definition.name, index))
+    
+    def success(self, definition, index, end):
+        self.events.append(("success", definition.name, index, end))
+    
+    def fail(self, definition, index):
+        self.events.append(("fail", definition.name, index))
+
+
+@pytest.mark.parametrize("engine", ["recursive", "iterative"])
+def test_traceHooks(engine):
+    recorder, profiler = Recorder(), metaparser.ElementProfiler()
+    for hook in (recorder, profiler):
+        parser = load("math")(hook=hook)
+        parser.feed("1+-(2)")
+        assert parser.parse(engine=engine) == -1
+        parser.clear()
+        parser.feed("1+(2")
+        with pytest.raises(metaparser.MatchError):
+            parser.parse(engine=engine)
+    events = recorder.events
+    assert events[0] == ("enter", "expr", 0) and ("success", "expr", 0, 6) in events
+    open = []
+    for event in events:
+        if event[0] == "enter":
+            open.append(event[1:])
+        else:
+            assert open.pop() == event[1:3]
+    assert not open
+    assert [event for event in events if event[0] == "fail"] == [("fail", "factor", 2), ("fail", "term", 2)]
+    calls = {}
+    for event in events:
+        if event[0] == "enter":
+            calls[event[1]] = calls.get(event[1], 0) + 1
+    assert {elem.name: stats["calls"] for elem, stats in profiler.stats.items()} == calls
+    assert {elem.name: stats["fails"] for elem, stats in profiler.stats.items() if stats["fails"]} == {"factor": 1, "term": 1}
+    assert metaparser.ParseContext().plain and not metaparser.ParseContext(hook=recorder).plain
+
+
+def test_importHasNoSideEffects(tmp_path):
+    import subprocess
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); import metaparser; "
+            "print(metaparser.MetaParser.defined, metaparser.MetaParser.analysis)")
+    result = subprocess.run([sys.executable, "-c", code, os.path.join(HERE, "..")], cwd=tmp_path,
+                            capture_output=True, text=True, check=True)
+    assert (result.stdout, result.stderr) == ("False None\n", "")
+    result = subprocess.run([sys.executable, os.path.join(HERE, "..", "metaparser.py"), os.path.join(HERE, "math.bbnf"),
+                             "--handlers", os.path.join(HERE, "math.py"), "1+2*(3-14)--17"],
+                            cwd=tmp_path, capture_output=True, text=True, check=True)
+    assert result.stdout == "-4\n"
+
+
+def test_charClassTables():
+    letter = metaparser.DisjunctionDef([metaparser.CharRangeDef("a", "z"), metaparser.StringDef("_"),
+                                        metaparser.DisjunctionDef([metaparser.CharSetDef("é€"),
+                                                                   metaparser.CharRangeDef("0", "9", True)])])
+    word = metaparser.RepetitionDef(letter, (1, -1))
+    root = metaparser.ElementDef("root")
+    root.define(metaparser.DisjunctionDef([word, metaparser.StringDef("9")]))
+    analysis = metaparser.GrammarAnalysis(root).install()
+    assert letter.charClass is analysis.classes[letter] and word.run is letter.charClass
+    
+    def shape(match):
+        if isinstance(match, metaparser.DisjunctionMatch):
+            return (match.id, shape(match.inner))
+        if isinstance(match, metaparser.ConcatenationMatch):
+            return [shape(inner) for inner in match.inners]
+        return str(match)
+    
+    def outcomes():
+        return [(lambda result: result and (shape(result[0]), result[1]))(
+            root.definition.match(text, 0, metaparser.ParseContext())) for text in texts]
+    texts = ["ab_é€9", "Z", "€" + chr(0x10FFFF), "_0", "7x", ""] + [chr(code) for code in range(0, 0x3000, 37)]
+    tabled = outcomes()
+    letter.charClass, word.run = None, None
+    assert outcomes() == tabled
+    assert tabled[:5] == [((0, [(0, "a"), (0, "b"), (1, "_"), (2, (0, "é")), (2, (0, "€"))]), 5),
+                          ((0, [(2, (1, "Z"))]), 1), ((0, [(2, (0, "€")), (2, (1, chr(0x10FFFF)))]), 2),
+                          ((0, [(1, "_")]), 1), None]
+
+
+def test_benchmarkBaselines(tmp_path, capsys):
+    import importlib.util
+    import json
+    spec = importlib.util.spec_from_file_location("bench", os.path.join(HERE, "..", "bench", "bench.py"))
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    assert bench.longExpression(50) == bench.longExpression(50) != bench.longExpression(50, seed=2)
+    baseline = {"a": {"seconds": 1.0, "bytesPerSecond": 100.0, "peakBytes": 10, "cachedSeconds": 1.0, "other": 1}}
+    results = {"a": {"seconds": 1.2, "bytesPerSecond": 70.0, "peakBytes": 20, "cachedSeconds": 0.5, "other": 9}}
+    assert [line.split(":")[0] for line in bench.compare(results, baseline, 0.25)] == ["a.bytesPerSecond", "a.peakBytes"]
+    
+    path = str(tmp_path / "baseline.json")
+    assert bench.main(["--quick", "math-stack", "--baseline", path, "--save"]) == 0
+    assert bench.main(["--quick", "math-stack", "--baseline", path]) == 0
+    with open(path) as file:
+        saved = json.load(file)
+    saved["quick"]["math-stack"]["frames"] /= 2
+    with open(path, "w") as file:
+        json.dump(saved, file)
+    assert bench.main(["--quick", "math-stack", "--baseline", path]) == 1
+    assert "REGRESSION math-stack.frames" in capsys.readouterr().out